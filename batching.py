@@ -0,0 +1,116 @@
+import random
+import torch
+import torch.nn.functional as F
+
+######################################################################
+# Mini-batched training
+# =====================
+#
+# The scripts train on one pair per optimizer step. The helpers below let
+# ``trainIters`` consume B pairs at a time instead: sentences are padded
+# into ``(T, B)`` index tensors with their real lengths kept alongside, and
+# the NLL loss is masked so padded positions contribute nothing.
+#
+# Index 2 is never handed out by ``Lang`` (SOS=0, EOS=1, and the first real
+# word gets 3), so it is used as the padding token.
+#
+
+SOS_token = 0
+EOS_token = 1
+PAD_token = 2
+
+
+def pad_sequences(sequences, device=None, pad_token=PAD_token):
+    # list of index lists -> (T, B) LongTensor, (B,) lengths
+    lengths = torch.tensor([len(seq) for seq in sequences], dtype=torch.long)
+    padded = torch.full((int(lengths.max()), len(sequences)), pad_token, dtype=torch.long)
+    for b, seq in enumerate(sequences):
+        padded[:len(seq), b] = torch.as_tensor(seq)
+    return padded.to(device), lengths
+
+
+def sequence_mask(lengths, max_len=None):
+    # (B,) lengths -> (T, B) bool mask, True on real tokens
+    max_len = max_len or int(lengths.max())
+    steps = torch.arange(max_len, device=lengths.device).unsqueeze(1)
+    return steps < lengths.unsqueeze(0)
+
+
+def masked_nll_loss(log_probs, target, mask):
+    # Sum of the NLL over the unmasked rows of one decoder step
+    nll = -log_probs.gather(1, target.unsqueeze(1)).squeeze(1)
+    return (nll * mask.to(nll.dtype)).sum()
+
+
+def encode_batch(encoder, input_batch, input_lengths, max_length):
+    # Encode a padded batch in one packed GRU call. Outputs past each
+    # sequence's end are zero, exactly as in the unbatched ``encoder_outputs``
+    # buffer, which is then padded out to the decoder's ``max_length``.
+    input_len, batch_size = input_batch.size()
+    encoder_hidden = encoder.initHidden(batch_size)
+    encoder_output, encoder_hidden = encoder.forward_sequence(input_batch, encoder_hidden, input_lengths)
+    encoder_outputs = F.pad(encoder_output.transpose(0, 1), (0, 0, 0, max_length - input_len))
+    return encoder_outputs, encoder_hidden
+
+
+def batch_loss(encoder, decoder, input_batch, input_lengths, target_batch, target_lengths,
+               use_teacher_forcing, max_length=None):
+    # Summed NLL over the real target tokens of a padded batch, and their count
+    max_length = max_length or decoder.max_length
+    batch_size = input_batch.size(1)
+    target_len = target_batch.size(0)
+    device = input_batch.device
+
+    encoder_outputs, encoder_hidden = encode_batch(encoder, input_batch, input_lengths, max_length)
+
+    decoder_input = torch.full((batch_size,), SOS_token, dtype=torch.long, device=device)
+    decoder_hidden = encoder_hidden
+
+    target_mask = sequence_mask(target_lengths.to(device), target_len)
+
+    if use_teacher_forcing:
+        # Teacher forcing: one decoder pass over the whole target, one
+        # vocabulary projection and one loss over all T x B positions
+        decoder_output, decoder_hidden = decoder.forward_teacher(
+            target_batch, decoder_hidden, encoder_outputs)
+        loss = masked_nll_loss(decoder_output.view(-1, decoder.output_size),
+                               target_batch.view(-1), target_mask.view(-1))
+        return loss, target_mask.sum()
+
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    n_tokens = torch.zeros((), device=device)
+    loss = 0
+
+    for di in range(target_len):
+        decoder_output, decoder_hidden, decoder_attention = decoder(
+            decoder_input, decoder_hidden, encoder_outputs)
+        step_mask = target_mask[di] & ~finished
+        loss = loss + masked_nll_loss(decoder_output, target_batch[di], step_mask)
+        n_tokens = n_tokens + step_mask.sum()
+
+        topv, topi = decoder_output.topk(1)
+        decoder_input = topi.squeeze(1).detach()  # detach from history as input
+        # a sequence stops contributing once it has predicted EOS
+        finished = finished | (decoder_input == EOS_token)
+        if bool(finished.all()):
+            break
+
+    return loss, n_tokens
+
+
+def train_batch(input_batch, input_lengths, target_batch, target_lengths, encoder, decoder,
+                encoder_optimizer, decoder_optimizer, teacher_forcing_ratio=0.5, max_length=None):
+    encoder_optimizer.zero_grad()
+    decoder_optimizer.zero_grad()
+
+    use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
+    loss, n_tokens = batch_loss(encoder, decoder, input_batch, input_lengths, target_batch,
+                                target_lengths, use_teacher_forcing, max_length)
+
+    # Scale by the batch so each sequence gets the same gradient as in train()
+    (loss / input_batch.size(1)).backward()
+
+    encoder_optimizer.step()
+    decoder_optimizer.step()
+
+    return loss.item() / n_tokens.item()
@@ -0,0 +1,272 @@
+import getopt
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from array import array
+
+import numpy as np
+
+from normalization import PROFILES, load_normalized, normalize_lines
+
+######################################################################
+# Binary corpus files
+# ===================
+#
+# ``readLangs`` used to read a whole ``question\answer`` text file, split it
+# into lines, and normalize every sentence, so the raw text, the lines and
+# the pairs were all in memory at once. ``python binary_corpus.py`` turns
+# the text files into one binary file each, next to the source:
+#
+#   data/100conver2.txt  ->  data/100conver2.<profile>.bin
+#
+# The file starts with an 8-byte magic string, the length of a JSON header,
+# then the header itself: source file, size, mtime and SHA-1, normalization
+# profile, separator, counts, and where each section starts. The sections,
+# each 8-byte aligned, are:
+#
+#   vocab             the distinct words, newline-separated, in order of first use
+#   line_offsets      int64, line ``i`` is sentences [line_offsets[i], line_offsets[i + 1])
+#   sentence_offsets  int64, sentence ``j`` is tokens [sentence_offsets[j], sentence_offsets[j + 1])
+#   tokens            int32 vocabulary ids
+#
+# A "sentence" is one normalized field of a line, and its words are the
+# field split on single spaces, so ``' '.join`` of the words gives back the
+# exact string the text path produces.
+#
+# ``BinaryCorpus`` memory-maps the offsets and tokens, so opening a corpus
+# reads the header and the vocabulary only; a line is decoded when it is
+# indexed. ``filter_lengths`` applies the scripts' length filter to the
+# offsets alone. ``open_corpus`` returns the binary corpus when it is up to
+# date with its source and falls back to the text path otherwise. Up to
+# date means the same size and mtime, or, when the mtime moved or with
+# ``verify``, the same SHA-1 as recorded in the header.
+#
+
+MAGIC = b'S2SCORP1'
+DEFAULT_INPUTS = [(path, '\\') for path in sorted(glob.glob('data/*.txt'))] + \
+                 [('data/Twitter/processed_Twitter.txt', '\t')]
+
+
+def binary_path(path, profile):
+    return '%s.%s.bin' % (os.path.splitext(path)[0], profile)
+
+
+def read_lines(path):
+    # the lines of open(path).read().strip().split('\n'), without reading the whole file
+    previous = None
+    blank = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.endswith('\n'):
+                line = line[:-1]
+            if not line.strip():
+                # whitespace-only lines are kept only between two other lines
+                if previous is not None:
+                    blank.append(line)
+                continue
+            if previous is None:
+                line = line.lstrip()
+            else:
+                yield previous
+                for b in blank:
+                    yield b
+            blank = []
+            previous = line
+    yield previous.rstrip() if previous is not None else ''
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _align(f):
+    f.write(b'\0' * (-f.tell() % 8))
+
+
+def build(path, profile, separator='\\', output=None):
+    output = output or binary_path(path, profile)
+    normalize = PROFILES[profile].normalize
+    vocab = {}
+    line_offsets = array('q', [0])
+    sentence_offsets = array('q', [0])
+    tokens = array('i')
+    source_sha1 = file_sha1(path)
+    stat = os.stat(path)
+
+    for line in read_lines(path):
+        for sentence in line.split(separator):
+            for word in normalize(sentence).split(' '):
+                index = vocab.get(word)
+                if index is None:
+                    index = vocab[word] = len(vocab)
+                tokens.append(index)
+            sentence_offsets.append(len(tokens))
+        line_offsets.append(len(sentence_offsets) - 1)
+
+    vocab_bytes = '\n'.join(vocab).encode('utf-8')
+    sections = [('vocab', vocab_bytes),
+                ('line_offsets', line_offsets.tobytes()),
+                ('sentence_offsets', sentence_offsets.tobytes()),
+                ('tokens', tokens.tobytes())]
+    header = dict(version=1, source=path, source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns,
+                  source_sha1=source_sha1, profile=PROFILES[profile].key, separator=separator,
+                  n_lines=len(line_offsets) - 1, n_sentences=len(sentence_offsets) - 1,
+                  n_tokens=len(tokens), vocab_size=len(vocab), sections={})
+    # section offsets go in the header, so lay the file out first
+    start = len(MAGIC) + 8 + 4096
+    header_bytes = b''
+    while True:
+        position = start
+        for name, data in sections:
+            position += -position % 8
+            header['sections'][name] = [position, len(data)]
+            position += len(data)
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        if len(MAGIC) + 8 + len(header_bytes) <= start:
+            break
+        start = len(MAGIC) + 8 + len(header_bytes) + 4096
+
+    # written under a temporary name and renamed, as in corpus_cache.py
+    tmp_output = output + '.tmp%d' % os.getpid()
+    with open(tmp_output, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.write(b'\0' * (start - f.tell()))
+        for name, data in sections:
+            _align(f)
+            assert f.tell() == header['sections'][name][0]
+            f.write(data)
+    os.replace(tmp_output, output)
+    return header
+
+
+class BinaryCorpus:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a binary corpus file' % path)
+            size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(f.read(size).decode('utf-8'))
+            start, length = self.header['sections']['vocab']
+            f.seek(start)
+            self.vocab = f.read(length).decode('utf-8').split('\n') if self.header['vocab_size'] else []
+        self.line_offsets = self._map('line_offsets', np.int64)
+        self.sentence_offsets = self._map('sentence_offsets', np.int64)
+        self.tokens = self._map('tokens', np.int32)
+
+    def _map(self, name, dtype):
+        start, length = self.header['sections'][name]
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=start, shape=(length // np.dtype(dtype).itemsize,))
+
+    def is_current(self, source=None, verify=False):
+        # True if the source file has not changed since the corpus was built. A
+        # new mtime alone is settled by the SHA-1; ``verify`` compares it even
+        # when the mtime is unchanged, for edits that kept it (or a coarse clock)
+        source = source or self.header['source']
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return False
+        if stat.st_size != self.header['source_size']:
+            return False
+        if verify or stat.st_mtime_ns != self.header['source_mtime_ns']:
+            return file_sha1(source) == self.header['source_sha1']
+        return True
+
+    def __len__(self):
+        return self.header['n_lines']
+
+    def sentence(self, j):
+        vocab = self.vocab
+        return ' '.join([vocab[t] for t in self.tokens[self.sentence_offsets[j]:self.sentence_offsets[j + 1]].tolist()])
+
+    def __getitem__(self, i):
+        # the normalized fields of line ``i``, as the text path returns them
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return [self.sentence(j) for j in range(int(self.line_offsets[i]), int(self.line_offsets[i + 1]))]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def filter_lengths(self, max_length):
+        # indexes of the lines with exactly two sentences of fewer than ``max_length`` words
+        short = (np.diff(self.sentence_offsets) < max_length).astype(np.int64)
+        counts = np.add.reduceat(short, self.line_offsets[:-1]) if len(self) else short[:0]
+        return np.flatnonzero(counts == 2)
+
+
+def open_corpus(path, profile, separator='\\', verify=False):
+    # the normalized pairs of ``path``, from its binary corpus when that is up to date
+    bin_path = binary_path(path, profile)
+    if os.path.exists(bin_path):
+        corpus = BinaryCorpus(bin_path)
+        if (corpus.is_current(path, verify) and corpus.header['profile'] == PROFILES[profile].key
+                and corpus.header['separator'] == separator):
+            return corpus
+        print("%s does not match %s or its settings, reading the text file" % (bin_path, path))
+    return load_normalized(path, profile, separator=separator)
+
+
+def benchmark(path, profile, separator='\\', max_length=10):
+    # time and peak Python memory of reading and length-filtering ``path``, text against binary
+    bin_path = binary_path(path, profile)
+    if not os.path.exists(bin_path):
+        build(path, profile, separator)
+
+    def text():
+        lines = open(path, encoding='utf-8').read().strip().split('\n')
+        pairs = normalize_lines(lines, profile, separator)
+        return [p for p in pairs if len([x for x in p if len(x.split(' ')) < max_length]) == 2]
+
+    def binary():
+        corpus = BinaryCorpus(bin_path)
+        return [corpus[i] for i in corpus.filter_lengths(max_length).tolist()]
+
+    results = {}
+    for name, load in (('text', text), ('binary', binary)):
+        start = time.perf_counter()
+        pairs = load()
+        elapsed = time.perf_counter() - start
+        # a second, traced run for memory, since tracing slows allocations down
+        tracemalloc.start()
+        load()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = pairs
+        print('%-7s %8.3fs  peak %8.1f MB  %d pairs' % (name, elapsed, peak / 2 ** 20, len(pairs)))
+    assert results['text'] == results['binary']
+
+
+if __name__ == '__main__':
+    # python binary_corpus.py --profile=en [--separator=tab] [--benchmark] [input files...]
+    opts, args = getopt.getopt(sys.argv[1:], '', ['profile=', 'separator=', 'benchmark'])
+    opts = dict(opts)
+    profile = opts.get('--profile', 'en')
+    separator = {'tab': '\t', 'backslash': '\\'}.get(opts.get('--separator'), opts.get('--separator', '\\'))
+    inputs = [(path, separator) for path in args] or DEFAULT_INPUTS
+    for path, sep in inputs:
+        if '--benchmark' in opts:
+            print(path)
+            benchmark(path, profile, sep)
+            continue
+        start = time.perf_counter()
+        header = build(path, profile, sep)
+        print('%s -> %s: %d lines, %d tokens, %d words (%.1fs)' % (
+            path, binary_path(path, profile), header['n_lines'], header['n_tokens'], header['vocab_size'],
+            time.perf_counter() - start))
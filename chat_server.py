@@ -0,0 +1,261 @@
+import asyncio
+import bisect
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+######################################################################
+# Chat server with dynamic micro-batching
+# =======================================
+#
+# ``serve`` runs a small asyncio HTTP server in front of a batched
+# ``respond(sentences) -> responses`` function (``evaluate_batch`` in the
+# scripts). Requests are not decoded one by one: they wait in a queue for
+# at most ``max_wait_ms`` milliseconds or until ``max_batch_size`` of them
+# have arrived, and the whole group goes through the model at once on a
+# single worker thread. While one batch is decoding the next one collects,
+# so under load batches grow by themselves and throughput goes up; when
+# traffic is light a request waits no more than ``max_wait_ms``.
+#
+#   POST /chat         {"sentence": "how are you"}  ->  {"response": "..."}
+#   POST /chat/stream  same request, the reply streamed word by word (chunked)
+#   GET  /stats        latency percentiles and the batch size histogram
+#
+# With a ``cache`` (a ``response_cache.ResponseCache``) and the served
+# model's ``version``, a request whose reply is cached is answered before it
+# joins a batch, and decoded replies are stored on the way back.
+#
+# Streamed replies come from ``stream(sentence)``, a generator of words.
+# They skip the batcher: each word is decoded by its own call on the model
+# thread and written out immediately, so the first word arrives after one
+# decoder step. A client that disconnects cancels the rest of its decode.
+#
+
+
+class ServerStats:
+    def __init__(self, window=10000):
+        # latencies of the last ``window`` requests, in seconds
+        self.latencies = deque(maxlen=window)
+        self.first_token_latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.requests = 0
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+        self.requests += 1
+
+    def record_first_token(self, seconds):
+        self.first_token_latencies.append(seconds)
+
+    def record_batch(self, size):
+        self.batch_sizes[size] += 1
+
+    def percentile(self, q, latencies=None):
+        latencies = self.latencies if latencies is None else latencies
+        if not latencies:
+            return 0.0
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+    def latency_histogram(self, bounds_ms=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)):
+        # requests per latency bucket, keyed by the bucket's upper bound in ms
+        counts = [0] * (len(bounds_ms) + 1)
+        for latency in self.latencies:
+            counts[bisect.bisect_left(bounds_ms, latency * 1000)] += 1
+        labels = ['<=%d' % b for b in bounds_ms] + ['>%d' % bounds_ms[-1]]
+        return dict(zip(labels, counts))
+
+    def summary(self):
+        batches = sum(self.batch_sizes.values())
+        return dict(requests=self.requests,
+                    latency_ms=dict(p50=self.percentile(50) * 1000, p99=self.percentile(99) * 1000),
+                    latency_histogram=self.latency_histogram(),
+                    first_token_ms=dict(p50=self.percentile(50, self.first_token_latencies) * 1000,
+                                        p99=self.percentile(99, self.first_token_latencies) * 1000),
+                    batches=batches,
+                    mean_batch_size=sum(k * v for k, v in self.batch_sizes.items()) / batches if batches else 0.0,
+                    batch_sizes={str(k): v for k, v in sorted(self.batch_sizes.items())})
+
+
+class MicroBatcher:
+    def __init__(self, respond, max_batch_size=32, max_wait_ms=5, stats=None, cache=None, version=None):
+        self.respond = respond
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = stats or ServerStats()
+        self.cache = cache
+        self.version = version
+        self.queue = asyncio.Queue()
+        # one thread, so the model never runs two batches at the same time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, sentence):
+        if self.cache is not None:
+            response = self.cache.get(sentence, self.version)
+            if response is not None:
+                return response
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, future))
+        response = await future
+        if self.cache is not None:
+            self.cache.put(sentence, self.version, response)
+        return response
+
+    def summary(self):
+        summary = self.stats.summary()
+        if self.cache is not None:
+            summary['cache'] = self.cache.stats()
+        return summary
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            sentences = [sentence for sentence, _ in batch]
+            try:
+                responses = await loop.run_in_executor(self.executor, self.respond, sentences)
+            except Exception:
+                # one bad sentence should not fail the whole batch: retry them one at a time
+                responses = []
+                for sentence in sentences:
+                    try:
+                        responses.append((await loop.run_in_executor(self.executor, self.respond, [sentence]))[0])
+                    except Exception as e:
+                        responses.append(e)
+            self.stats.record_batch(len(batch))
+            for (_, future), response in zip(batch, responses):
+                # the client may have gone away in the meantime
+                if future.done():
+                    continue
+                if isinstance(response, Exception):
+                    future.set_exception(response)
+                else:
+                    future.set_result(response)
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+
+def _write_response(writer, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json; charset=utf-8\r\n'
+                  'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode('latin-1'))
+    writer.write(body)
+
+
+def _write_chunk(writer, data):
+    writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+
+async def _stream_response(writer, batcher, words, start):
+    # chunked reply, one word per chunk, each decoded on the model thread
+    loop = asyncio.get_running_loop()
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n'
+                 b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+    first = True
+    try:
+        while True:
+            try:
+                word = await loop.run_in_executor(batcher.executor, next, words, None)
+            except Exception:
+                # the headers are already out: drop the connection without the
+                # final chunk so the client can tell the reply is incomplete
+                return
+            if word is None:
+                break
+            if first:
+                batcher.stats.record_first_token(time.perf_counter() - start)
+            _write_chunk(writer, (word if first else ' ' + word).encode('utf-8'))
+            first = False
+            await writer.drain()
+        _write_chunk(writer, b'')
+        await writer.drain()
+        batcher.stats.record_latency(time.perf_counter() - start)
+    finally:
+        # stops the decode if the client went away
+        await loop.run_in_executor(batcher.executor, words.close)
+
+
+def make_handler(batcher, normalize, stream=None):
+    async def handle(reader, writer):
+        start = time.perf_counter()
+        try:
+            request = await _read_request(reader)
+            if request is None:
+                return
+            method, path, body = request
+            if method == 'GET' and path == '/stats':
+                _write_response(writer, '200 OK', batcher.summary())
+            elif method == 'POST' and path in ('/chat', '/chat/stream'):
+                try:
+                    sentence = json.loads(body.decode('utf-8'))['sentence']
+                except (ValueError, KeyError, TypeError):
+                    _write_response(writer, '400 Bad Request', {'error': 'expected {"sentence": "..."}'})
+                else:
+                    if path == '/chat/stream' and stream is not None:
+                        await _stream_response(writer, batcher, stream(normalize(sentence)), start)
+                        return
+                    try:
+                        response = await batcher.submit(normalize(sentence))
+                    except Exception as e:
+                        _write_response(writer, '500 Internal Server Error', {'error': repr(e)})
+                    else:
+                        batcher.stats.record_latency(time.perf_counter() - start)
+                        _write_response(writer, '200 OK', {'response': response})
+            else:
+                _write_response(writer, '404 Not Found', {'error': 'unknown endpoint'})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def _serve(respond, normalize, host, port, max_batch_size, max_wait_ms, stream, cache, version):
+    batcher = MicroBatcher(respond, max_batch_size, max_wait_ms, cache=cache, version=version)
+    worker = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher, normalize, stream), host, port)
+    print('Serving on http://%s:%d (batches of up to %d, %d ms wait)' % (host, port, max_batch_size, max_wait_ms))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+        batcher.executor.shutdown(wait=False)
+
+
+def serve(respond, normalize=lambda s: s, host='127.0.0.1', port=8000, max_batch_size=32, max_wait_ms=5,
+          stream=None, cache=None, version=None):
+    try:
+        asyncio.run(_serve(respond, normalize, host, port, max_batch_size, max_wait_ms, stream, cache, version))
+    except KeyboardInterrupt:
+        pass
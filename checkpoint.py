@@ -0,0 +1,160 @@
+import copy
+import glob
+import os
+import random
+import threading
+import time
+import torch
+
+######################################################################
+# Asynchronous checkpoints
+# ========================
+#
+# ``trainIters`` used to stop every ``print_every`` iterations to pickle the
+# encoder and decoder straight over ``encoder.pkl``/``decoder.pkl``; a crash
+# in the middle of a write left no usable copy. ``CheckpointWriter`` copies
+# the weights to CPU memory on the training thread (a plain memcpy) and
+# leaves serialization to a background thread, which writes each file to a
+# temporary name and ``os.replace``-s it into place. It keeps the ``keep``
+# most recently written ``checkpoint-<step>.pt`` files (by write time, not
+# step, so a fresh run is not pruned in favour of an earlier run's higher
+# steps, and ``load_latest`` resumes the newest run) and still refreshes
+# the module pickles the scripts load. If a write is still running when
+# the next snapshot arrives, the older pending snapshot is dropped, so
+# training never waits on the disk.
+#
+
+
+def atomic_save(obj, path):
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def cpu_state_dict(module):
+    return {k: v.detach().to('cpu', copy=True) for k, v in module.state_dict().items()}
+
+
+def cpu_copy(obj):
+    # detached CPU copies of every tensor in a nested state (optimizer states are updated in place)
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def _written_at(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+
+def list_checkpoints(directory):
+    # oldest write first: a fresh run's low steps are newer than an earlier run's high ones
+    return sorted(glob.glob(os.path.join(directory, 'checkpoint-*.pt')), key=lambda path: (_written_at(path), path))
+
+
+######################################################################
+# Resuming
+# --------
+#
+# Besides the weights, a checkpoint can carry everything ``trainIters``
+# needs to continue where it stopped: both Adam optimizers (so the moment
+# estimates survive a restart), the Python and torch RNG states, the
+# iteration count, the loss history and the sampler position.
+#
+
+def training_state(encoder_optimizer, decoder_optimizer, **metrics):
+    return dict(encoder_optimizer=cpu_copy(encoder_optimizer.state_dict()),
+                decoder_optimizer=cpu_copy(decoder_optimizer.state_dict()),
+                python_rng=random.getstate(), torch_rng=torch.get_rng_state(),
+                metrics=copy.deepcopy(metrics))
+
+
+def load_latest(directory):
+    # newest readable checkpoint, or None; a damaged file falls back to the one before it
+    for path in reversed(list_checkpoints(directory)):
+        try:
+            return torch.load(path, map_location='cpu')
+        except Exception as e:
+            print('Skipping unreadable checkpoint %s: %s' % (path, e))
+    return None
+
+
+def restore_training_state(state, encoder, decoder, encoder_optimizer, decoder_optimizer):
+    encoder.load_state_dict(state['encoder'])
+    decoder.load_state_dict(state['decoder'])
+    if 'encoder_optimizer' in state:
+        encoder_optimizer.load_state_dict(state['encoder_optimizer'])
+        decoder_optimizer.load_state_dict(state['decoder_optimizer'])
+        random.setstate(state['python_rng'])
+        torch.set_rng_state(state['torch_rng'])
+    return state.get('metrics', {})
+
+
+class CheckpointWriter:
+    def __init__(self, directory, keep=3, every_seconds=None):
+        self.directory = directory
+        self.keep = keep
+        self.every_seconds = every_seconds
+        self.last_save = time.time()
+        self._pending = None
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def due(self):
+        # wall-clock cadence; without one, the caller decides when to save
+        return self.every_seconds is not None and time.time() - self.last_save >= self.every_seconds
+
+    def save(self, encoder, decoder, step, **extra):
+        self._raise_error()
+        snapshot = dict(step=step, encoder=cpu_state_dict(encoder), decoder=cpu_state_dict(decoder), **extra)
+        modules = {'encoder.pkl': copy.deepcopy(encoder).cpu(), 'decoder.pkl': copy.deepcopy(decoder).cpu()}
+        with self._cond:
+            self._pending = (snapshot, modules)
+            self._cond.notify()
+        self.last_save = time.time()
+
+    def close(self):
+        # wait for the last snapshot to reach the disk
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                (snapshot, modules), self._pending = self._pending, None
+            try:
+                self._write(snapshot, modules)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, snapshot, modules):
+        os.makedirs(self.directory, exist_ok=True)
+        atomic_save(snapshot, os.path.join(self.directory, 'checkpoint-%08d.pt' % snapshot['step']))
+        for name, module in modules.items():
+            atomic_save(module, os.path.join(self.directory, name))
+        for path in list_checkpoints(self.directory)[:-self.keep]:
+            os.remove(path)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import shutil
+import numpy as np
+import torch
+
+from batching import EOS_token
+
+######################################################################
+# Pre-tensorized corpus cache
+# ===========================
+#
+# ``tensorsFromPair`` turns the two strings of a pair into index lists and
+# fresh tensors on every training step. Here every filtered pair is encoded
+# once into flat int32 token arrays (EOS included) plus an offsets index:
+# pair ``i`` is ``tokens[offsets[i]:offsets[i + 1]]``. The arrays are saved
+# as ``.npy`` files under a key made from the corpus and vocabulary hashes,
+# and reopened memory-mapped, so a restarted run skips tokenization and the
+# training loop only slices arrays.
+#
+
+CACHE_DIR = 'data/cache'
+
+
+def corpus_key(pairs, input_lang, output_lang):
+    h = hashlib.sha1()
+    for pair in pairs:
+        h.update(('%s\t%s\n' % (pair[0], pair[1])).encode('utf-8'))
+    for lang in (input_lang, output_lang):
+        h.update(lang.name.encode('utf-8'))
+        for word, index in sorted(lang.word2index.items(), key=lambda item: item[1]):
+            h.update(('%s %d\n' % (word, index)).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def _flatten(sequences):
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seq) for seq in sequences])
+    tokens = np.fromiter((index for seq in sequences for index in seq), dtype=np.int32, count=int(offsets[-1]))
+    return tokens, offsets
+
+
+class TensorCorpus:
+    def __init__(self, path):
+        # copy-on-write maps are writable views, so torch.from_numpy accepts them without copying
+        self.path = path
+        self.src_tokens = np.load(os.path.join(path, 'src_tokens.npy'), mmap_mode='c')
+        self.src_offsets = np.load(os.path.join(path, 'src_offsets.npy'))
+        self.tgt_tokens = np.load(os.path.join(path, 'tgt_tokens.npy'), mmap_mode='c')
+        self.tgt_offsets = np.load(os.path.join(path, 'tgt_offsets.npy'))
+
+    def __getstate__(self):
+        # worker processes reopen the maps instead of receiving a copy of them
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def indexes(self, i):
+        src = torch.from_numpy(self.src_tokens[self.src_offsets[i]:self.src_offsets[i + 1]])
+        tgt = torch.from_numpy(self.tgt_tokens[self.tgt_offsets[i]:self.tgt_offsets[i + 1]])
+        return src, tgt
+
+    def lengths(self):
+        return list(zip(np.diff(self.src_offsets).tolist(), np.diff(self.tgt_offsets).tolist()))
+
+
+def build_cache(path, pairs, input_lang, output_lang, indexes_fn):
+    src, tgt = [], []
+    for pair in pairs:
+        src.append(indexes_fn(input_lang, pair[0]) + [EOS_token])
+        tgt.append(indexes_fn(output_lang, pair[1]) + [EOS_token])
+
+    # write into a scratch directory and rename it into place, so an
+    # interrupted build never leaves a half-written cache behind
+    tmp_path = path + '.tmp%d' % os.getpid()
+    os.makedirs(tmp_path)
+    for name, sequences in (('src', src), ('tgt', tgt)):
+        tokens, offsets = _flatten(sequences)
+        np.save(os.path.join(tmp_path, name + '_tokens.npy'), tokens)
+        np.save(os.path.join(tmp_path, name + '_offsets.npy'), offsets)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_corpus(pairs, input_lang, output_lang, indexes_fn, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, corpus_key(pairs, input_lang, output_lang))
+    if not os.path.isdir(path):
+        print("Building tensor cache %s..." % path)
+        os.makedirs(cache_dir, exist_ok=True)
+        build_cache(path, pairs, input_lang, output_lang, indexes_fn)
+    return TensorCorpus(path)
@@ -0,0 +1,72 @@
+import torch
+from torch.utils.data import DataLoader, Dataset, RandomSampler, Subset
+
+from batching import pad_sequences
+
+######################################################################
+# Background data loading
+# =======================
+#
+# ``trainIters`` used to prepare every batch on the thread that runs the
+# forward and backward passes. ``make_loader`` wraps the cached corpus in a
+# ``torch.utils.data.DataLoader``: worker processes slice and pad batches
+# while the model trains, and each worker keeps at most ``prefetch_factor``
+# batches queued ahead of the trainer.
+#
+
+
+class PairDataset(Dataset):
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __getitem__(self, i):
+        return self.corpus.indexes(i)
+
+
+def collate_pairs(items):
+    # list of (src, tgt) index tensors -> padded (T, B) batches and lengths
+    src, tgt = zip(*items)
+    input_batch, input_lengths = pad_sequences(src)
+    target_batch, target_lengths = pad_sequences(tgt)
+    return input_batch, input_lengths, target_batch, target_lengths
+
+
+def collate_single(item):
+    # one (src, tgt) pair -> the (T, 1) tensors train() expects
+    src, tgt = item
+    return src.long().view(-1, 1), tgt.long().view(-1, 1)
+
+
+def make_loader(corpus, batch_sampler=None, num_samples=None, num_workers=0, prefetch_factor=2, indices=None,
+                seed=0):
+    # With a batch sampler the loader yields padded batches for train_batch;
+    # without one it draws ``num_samples`` single pairs with replacement,
+    # like the original ``random.choice(pairs)`` loop. ``indices`` restricts
+    # the loader to a subset of the corpus; sampler positions then refer to it.
+    # The loader draws from its own seeded generator rather than the global
+    # torch RNG, so a resumed run sees the same dropout masks.
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    options = dict(num_workers=num_workers, pin_memory=torch.cuda.is_available(), generator=generator)
+    if num_workers > 0:
+        options.update(prefetch_factor=prefetch_factor, persistent_workers=True)
+    dataset = PairDataset(corpus)
+    if indices is not None:
+        dataset = Subset(dataset, indices)
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_pairs, **options)
+    sampler = RandomSampler(dataset, replacement=True, num_samples=num_samples, generator=generator)
+    return DataLoader(dataset, batch_size=None, sampler=sampler, collate_fn=collate_single, **options)
+
+
+def cycle(loader):
+    # Endless stream of batches, moving the bucket sampler to a new epoch
+    # each time the corpus has been seen once
+    while True:
+        for batch in loader:
+            yield batch
+        if loader.batch_sampler is not None and hasattr(loader.batch_sampler, 'set_epoch'):
+            loader.batch_sampler.set_epoch(loader.batch_sampler.epoch + 1)
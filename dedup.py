@@ -0,0 +1,135 @@
+import hashlib
+from collections import Counter
+
+import numpy as np
+
+######################################################################
+# Pair deduplication
+# ==================
+#
+# Subtitle and Twitter exchanges repeat a lot ("yes"/"no", "ok"/"ok"), and
+# ``random.choice(pairs)`` spends training steps on every copy.
+# ``deduplicate`` runs once over the normalized, filtered pairs and keeps
+# the first occurrence of:
+#
+# -  every exact pair: an 8-byte hash of the pair goes into a set, so
+#    memory grows with the number of distinct pairs, not with their text;
+# -  with ``near_duplicates``, every group of pairs whose word sets overlap
+#    by at least ``threshold`` (Jaccard similarity). Each pair gets a
+#    MinHash signature of ``num_perm`` values; pairs agreeing on all the
+#    values of one of ``bands`` bands are compared, and a pair whose
+#    signatures agree on a ``threshold`` share of the values with a kept
+#    pair is dropped;
+# -  every response, at most ``max_response_count`` times.
+#
+# ``deduplicate`` returns the pairs kept along with statistics of the pairs
+# before and after, which ``print_report`` prints.
+#
+
+_PRIME = (1 << 31) - 1
+
+
+def pair_hash(pair):
+    return hashlib.blake2b(('%s\t%s' % (pair[0], pair[1])).encode('utf-8'), digest_size=8).digest()
+
+
+class MinHasher:
+    def __init__(self, num_perm=32, bands=8, seed=0):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _PRIME, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, num_perm).astype(np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+
+    def signature(self, words):
+        # min over the words of (a * h + b) mod p, for each of the num_perm (a, b)
+        hashes = np.array([int.from_bytes(hashlib.blake2b(w.encode('utf-8'), digest_size=4).digest(), 'little')
+                           for w in set(words)] or [0], dtype=np.uint64) % _PRIME
+        return ((np.outer(hashes, self.a) + self.b) % _PRIME).min(axis=0)
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+
+def _pair_words(pair):
+    # question and answer words kept apart, so "a"/"b" and "b"/"a" differ
+    return ['q:' + w for w in pair[0].split(' ')] + ['a:' + w for w in pair[1].split(' ')]
+
+
+def _stats(n_pairs, distinct_pairs, responses, top):
+    return dict(pairs=n_pairs, distinct_pairs=distinct_pairs, distinct_responses=len(responses),
+                duplicate_rate=1 - distinct_pairs / n_pairs if n_pairs else 0.0,
+                top_responses=responses.most_common(top))
+
+
+def deduplicate(pairs, near_duplicates=False, threshold=0.8, num_perm=32, bands=8, max_response_count=None,
+                top=5):
+    # (pairs kept, report); ``pairs`` may be any iterable and is read once
+    seen = set()
+    hasher = MinHasher(num_perm, bands) if near_duplicates else None
+    buckets = {}  # (band, band values) -> signatures of the kept pairs in that bucket
+    all_responses = Counter()
+    responses = Counter()
+    n_pairs = 0
+    kept = []
+    dropped = Counter()
+    for pair in pairs:
+        n_pairs += 1
+        all_responses[pair[1]] += 1
+        key = pair_hash(pair)
+        if key in seen:
+            dropped['exact'] += 1
+            continue
+        seen.add(key)
+        if max_response_count is not None and responses[pair[1]] >= max_response_count:
+            dropped['response_cap'] += 1
+            continue
+        if hasher is not None:
+            signature = hasher.signature(_pair_words(pair))
+            band_keys = hasher.band_keys(signature)
+            if any((other == signature).mean() >= threshold
+                   for band_key in band_keys for other in buckets.get(band_key, ())):
+                dropped['near'] += 1
+                continue
+            for band_key in band_keys:
+                buckets.setdefault(band_key, []).append(signature)
+        responses[pair[1]] += 1
+        kept.append(pair)
+    # every kept pair is distinct
+    report = dict(before=_stats(n_pairs, len(seen), all_responses, top),
+                  after=_stats(len(kept), len(kept), responses, top), dropped=dict(dropped))
+    return kept, report
+
+
+def print_report(report):
+    for name in ('before', 'after'):
+        stats = report[name]
+        print('%-6s %d pairs, %d distinct, %d distinct responses, %.1f%% duplicates; top: %s' % (
+            name, stats['pairs'], stats['distinct_pairs'], stats['distinct_responses'],
+            stats['duplicate_rate'] * 100,
+            ', '.join('"%s" x%d' % (response, count) for response, count in stats['top_responses'])))
+    print('dropped: %s' % (', '.join('%s %d' % item for item in sorted(report['dropped'].items())) or 'none'))
+
+
+######################################################################
+# Held-out pairs
+# ==============
+#
+# ``is_held_out`` sets aside a fixed share of the pairs for evaluation. The
+# choice depends on the pair's hash only, not on its position or on a
+# random draw, so every run, and every script that scores a model, agrees
+# on which pairs training never saw.
+#
+
+def is_held_out(pair, fraction):
+    return int.from_bytes(pair_hash(pair), 'little') / 2.0 ** 64 < fraction
+
+
+def split_held_out(pairs, fraction):
+    # (training pairs, held-out pairs), each in corpus order
+    train, held_out = [], []
+    for pair in pairs:
+        (held_out if is_held_out(pair, fraction) else train).append(pair)
+    return train, held_out
@@ -0,0 +1,156 @@
+import copy
+import os
+import random
+import socket
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch import optim
+from torch.nn.parallel import DistributedDataParallel
+
+from batching import batch_loss
+from checkpoint import CheckpointWriter, training_state, load_latest, restore_training_state
+from data_loader import make_loader, cycle
+from sampler import BucketBatchSampler
+
+######################################################################
+# Data-parallel CPU training
+# ==========================
+#
+# ``train_distributed`` starts ``world_size`` processes on the gloo backend.
+# Every process trains a replica of the encoder and decoder on its own
+# shard of the corpus, and DistributedDataParallel averages the gradients
+# after each backward pass. Only rank 0 prints progress and writes
+# checkpoints and ``encoder.pkl``/``decoder.pkl``. The checkpoints carry
+# both Adam optimizers and the loss history as ``trainIters`` writes them,
+# so ``resume`` (here or in ``trainIters``) continues from the latest one.
+#
+# DistributedDataParallel expects one ``forward`` per backward pass, while
+# the decoder is called once per target step, so both modules are wrapped
+# in ``Seq2SeqLoss``, whose single forward computes the whole batch loss.
+#
+
+
+class Seq2SeqLoss(nn.Module):
+    def __init__(self, encoder, decoder):
+        super(Seq2SeqLoss, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(self, input_batch, input_lengths, target_batch, target_lengths, use_teacher_forcing):
+        return batch_loss(self.encoder, self.decoder, input_batch, input_lengths,
+                          target_batch, target_lengths, use_teacher_forcing)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, port, results, encoder, decoder, corpus, n_iters, save_dir, resume,
+            batch_size, learning_rate, print_every, teacher_forcing_ratio, seed):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    # share the cores out between the processes instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    # one Adam per module, as in trainIters, so checkpoints restore in either
+    encoder_optimizer = optim.Adam(encoder.parameters(), lr=learning_rate)
+    decoder_optimizer = optim.Adam(decoder.parameters(), lr=learning_rate)
+    start_iter = 1
+    all_losses = []
+    state = load_latest(save_dir) if resume and save_dir is not None else None
+    if state is not None:
+        # every rank restores the same checkpoint before DDP compares the replicas
+        all_losses = restore_training_state(state, encoder, decoder, encoder_optimizer,
+                                            decoder_optimizer).get('all_losses', [])
+        start_iter = state['step'] + 1
+        if rank == 0:
+            print('Resuming from iteration %d' % start_iter)
+    random.seed(seed + rank + start_iter - 1)
+    torch.manual_seed(seed + start_iter - 1)
+
+    model = DistributedDataParallel(Seq2SeqLoss(encoder, decoder))
+
+    # every rank gets its own shard of the pairs
+    shard = list(range(rank, len(corpus), world_size))
+    lengths = corpus.lengths()
+    # a resumed run draws new batches instead of replaying the first ones
+    sampler = BucketBatchSampler([lengths[i] for i in shard], batch_size, seed=seed + rank + start_iter - 1)
+    batches = cycle(make_loader(corpus, sampler, indices=shard))
+
+    checkpoints = None
+    if rank == 0 and save_dir is not None:
+        checkpoints = CheckpointWriter(save_dir)
+
+    def saveCheckpoint(iter):
+        # rank 0's losses stand for the run's, as in its progress lines
+        checkpoints.save(encoder, decoder, iter, **training_state(
+            encoder_optimizer, decoder_optimizer, all_losses=all_losses))
+
+    start = time.time()
+    print_loss_total = 0  # Reset every print_every
+    n_pairs = 0
+    for iter in range(start_iter, n_iters + 1):
+        input_batch, input_lengths, target_batch, target_lengths = next(batches)
+        encoder_optimizer.zero_grad()
+        decoder_optimizer.zero_grad()
+        use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
+        loss, n_tokens = model(input_batch, input_lengths, target_batch, target_lengths, use_teacher_forcing)
+        (loss / input_batch.size(1)).backward()
+        encoder_optimizer.step()
+        decoder_optimizer.step()
+
+        all_losses.append(loss.item() / n_tokens.item())
+        print_loss_total += all_losses[-1]
+        n_pairs += input_batch.size(1)
+
+        if iter % print_every == 0:
+            if rank == 0:
+                print('rank 0: (%d %d%%) %.4f, %.1fs' % (iter, iter / n_iters * 100,
+                                                        print_loss_total / print_every, time.time() - start))
+                if checkpoints is not None:
+                    saveCheckpoint(iter)
+            print_loss_total = 0
+
+    elapsed = time.time() - start
+    total_pairs = torch.tensor([float(n_pairs)])
+    dist.all_reduce(total_pairs)
+    if rank == 0:
+        if checkpoints is not None:
+            # a resume already past n_iters has nothing new to save
+            if start_iter <= n_iters:
+                saveCheckpoint(n_iters)
+            checkpoints.close()
+        results.put(total_pairs.item() / elapsed if n_pairs else 0.0)
+    dist.destroy_process_group()
+
+
+def _launch(world_size, encoder, decoder, corpus, n_iters, save_dir, resume, *args):
+    results = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(_worker, args=(world_size, _free_port(), results, encoder, decoder, corpus,
+                            n_iters, save_dir, resume) + args, nprocs=world_size, join=True)
+    return results.get()
+
+
+def train_distributed(encoder, decoder, corpus, n_iters, world_size, save_dir, batch_size=32,
+                      learning_rate=0.001, print_every=1000, teacher_forcing_ratio=0.5, seed=0,
+                      baseline_iters=50, resume=False):
+    # Returns throughput in pairs/second for the distributed run and for a
+    # short single-process baseline on a throwaway copy of the models, and
+    # the scaling efficiency between them. With ``resume``, the run continues
+    # from the latest checkpoint in ``save_dir``.
+    args = (batch_size, learning_rate, print_every, teacher_forcing_ratio, seed)
+    stats = {}
+    if baseline_iters:
+        stats['baseline'] = _launch(1, copy.deepcopy(encoder), copy.deepcopy(decoder), corpus,
+                                    baseline_iters, None, False, *args)
+    stats['distributed'] = _launch(world_size, encoder, decoder, corpus, n_iters, save_dir, resume, *args)
+    print('%d processes: %.1f pairs/s' % (world_size, stats['distributed']))
+    if baseline_iters:
+        stats['efficiency'] = stats['distributed'] / (world_size * stats['baseline'])
+        print('1 process: %.1f pairs/s, scaling efficiency %.1f%%' % (stats['baseline'], stats['efficiency'] * 100))
+    return stats
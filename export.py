@@ -0,0 +1,119 @@
+import json
+import os
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+######################################################################
+# TorchScript export
+# ==================
+#
+# ``encoder.pkl`` and ``decoder.pkl`` are pickled modules: unpickling them
+# needs ``EncoderRNN``/``AttnDecoderRNN`` importable, and importing a
+# training script runs ``prepareData`` over the whole corpus. ``export_models``
+# instead writes TorchScript programs for the encoder and for one decoder
+# step, plus the two vocabularies as JSON:
+#
+#   <directory>/encoder.pt       (T,) indexes -> (max_length, H) outputs, (1, 1, H) hidden
+#   <directory>/decoder_step.pt  one greedy step, as ``AttnDecoderRNN.forward`` in eval mode
+#   <directory>/vocab.json       input word2index, output index2word, max_length
+#
+# ``ScriptedChatbot`` loads those files with nothing but torch, so a serving
+# process starts without the training code and every decoder step runs as
+# one TorchScript call instead of a chain of Python module calls.
+#
+
+SOS_token = 0
+EOS_token = 1
+# evaluate() in the scripts keeps the first 50 input indexes (EOS included)
+MAX_INPUT_LENGTH = 50
+
+
+class ScriptEncoder(nn.Module):
+    def __init__(self, encoder, max_length):
+        super(ScriptEncoder, self).__init__()
+        self.hidden_size = encoder.hidden_size
+        self.max_length = max_length
+        self.embedding = encoder.embedding
+        self.gru = encoder.gru
+
+    def forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        embedded = self.embedding(input).unsqueeze(1)
+        hidden = torch.zeros(1, 1, self.hidden_size, device=input.device)
+        output, hidden = self.gru(embedded, hidden)
+        return F.pad(output[:, 0], [0, 0, 0, self.max_length - input.size(0)]), hidden
+
+
+class ScriptDecoderStep(nn.Module):
+    # AttnDecoderRNN.forward for one sentence, without dropout
+    def __init__(self, decoder):
+        super(ScriptDecoderStep, self).__init__()
+        self.embedding = decoder.embedding
+        self.attn = decoder.attn
+        self.attn_combine = decoder.attn_combine
+        self.gru = decoder.gru
+        self.out = decoder.out
+
+    def forward(self, input: torch.Tensor, hidden: torch.Tensor,
+                encoder_outputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        embedded = self.embedding(input)
+        attn_weights = F.softmax(self.attn(torch.cat((embedded, hidden[0]), 1)), dim=1)
+        attn_applied = torch.mm(attn_weights, encoder_outputs)
+        output = F.relu(self.attn_combine(torch.cat((embedded, attn_applied), 1))).unsqueeze(0)
+        output, hidden = self.gru(output, hidden)
+        return F.log_softmax(self.out(output[0]), dim=1), hidden, attn_weights
+
+
+def export_models(encoder, decoder, input_lang, output_lang, directory, max_length):
+    os.makedirs(directory, exist_ok=True)
+    encoder = ScriptEncoder(encoder, max_length).cpu().eval()
+    decoder_step = ScriptDecoderStep(decoder).cpu().eval()
+    torch.jit.save(torch.jit.script(encoder), os.path.join(directory, 'encoder.pt'))
+    torch.jit.save(torch.jit.script(decoder_step), os.path.join(directory, 'decoder_step.pt'))
+    vocab = dict(max_length=max_length, input_word2index=input_lang.word2index,
+                 output_index2word={str(k): v for k, v in output_lang.index2word.items()})
+    with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f, ensure_ascii=False)
+
+
+class ScriptedChatbot:
+    def __init__(self, directory, tokenize=None, device='cpu'):
+        # ``tokenize`` splits a normalized sentence into words (default: on spaces)
+        self.device = torch.device(device)
+        self.encoder = torch.jit.load(os.path.join(directory, 'encoder.pt'), map_location=self.device)
+        self.decoder_step = torch.jit.load(os.path.join(directory, 'decoder_step.pt'), map_location=self.device)
+        with open(os.path.join(directory, 'vocab.json'), encoding='utf-8') as f:
+            vocab = json.load(f)
+        self.max_length = vocab['max_length']
+        self.word2index = vocab['input_word2index']
+        self.index2word = {int(k): v for k, v in vocab['output_index2word'].items()}
+        self.tokenize = tokenize or (lambda sentence: sentence.split(' '))
+
+    def evaluate(self, sentence):
+        # same words and attentions as evaluate() in the training scripts
+        indexes = [self.word2index[word] if word in self.word2index else self.word2index['UNK']
+                   for word in self.tokenize(sentence)]
+        # cut where evaluate() cuts, and never past the max_length the encoder pads its outputs to
+        input_tensor = torch.tensor((indexes + [EOS_token])[:min(MAX_INPUT_LENGTH, self.max_length)],
+                                    dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            encoder_outputs, decoder_hidden = self.encoder(input_tensor)
+            decoder_input = torch.tensor([SOS_token], device=self.device)
+            decoded_words = []
+            decoder_attentions = torch.zeros(self.max_length, self.max_length)
+            for di in range(self.max_length):
+                decoder_output, decoder_hidden, decoder_attention = self.decoder_step(
+                    decoder_input, decoder_hidden, encoder_outputs)
+                decoder_attentions[di] = decoder_attention[0]
+                topi = int(decoder_output.argmax(1))
+                if topi == EOS_token:
+                    decoded_words.append('<EOS>')
+                    break
+                decoded_words.append(self.index2word[topi])
+                decoder_input = torch.tensor([topi], device=self.device)
+        return decoded_words[:-1], decoder_attentions[:di + 1]
+
+    def respond(self, sentence):
+        return ' '.join(self.evaluate(sentence)[0])
@@ -0,0 +1,333 @@
+import weakref
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from batching import SOS_token, EOS_token, encode_batch
+
+######################################################################
+# Batched greedy decoding
+# =======================
+#
+# ``evaluate`` decodes one sentence at a time and calls ``topi.item()`` on
+# every step, so each generated word costs a device sync and a trip through
+# Python. ``greedy_decode`` runs a whole padded batch through the encoder
+# at once and then steps the decoder for all sentences in lockstep. A
+# finished mask records which sentences have produced EOS; the loop stops
+# as soon as every sentence has, and the token ids are copied back in one
+# transfer at the end. With ``eos_check_every`` > 1 the mask is only read
+# back every few steps: a few steps may be decoded past the last EOS, but
+# the host waits for the device that many times less often. That only pays
+# off on a GPU; on the CPU reading the mask is free, so by default
+# (``None``) it is checked every step there.
+#
+
+
+def eos_interval(eos_check_every, device):
+    if eos_check_every is None:
+        return 1 if torch.device(device).type == 'cpu' else 8
+    return eos_check_every
+
+
+def greedy_decode(encoder, decoder, input_batch, input_lengths, max_length, return_attentions=False,
+                  eos_check_every=None):
+    # Returns, per sentence, the generated ids and the number of steps up
+    # to and including its EOS (``max_length`` if it never produced one),
+    # plus the (B, steps, max_length) attention weights when asked for
+    batch_size = input_batch.size(1)
+    device = input_batch.device
+    eos_check_every = eos_interval(eos_check_every, device)
+
+    encoder_outputs, encoder_hidden = encode_batch(encoder, input_batch, input_lengths, max_length)
+
+    decoder_input = torch.full((batch_size,), SOS_token, dtype=torch.long, device=device)
+    decoder_hidden = encoder_hidden
+
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    steps = torch.full((batch_size,), max_length, dtype=torch.long, device=device)
+    tokens, attentions = [], []
+
+    for di in range(max_length):
+        decoder_output, decoder_hidden, decoder_attention = decoder(
+            decoder_input, decoder_hidden, encoder_outputs)
+        decoder_input = decoder_output.argmax(1)
+        tokens.append(decoder_input)
+        if return_attentions:
+            attentions.append(decoder_attention)
+
+        # remember the step at which each sentence first produced EOS
+        new_eos = (decoder_input == EOS_token) & ~finished
+        steps = torch.where(new_eos, torch.full_like(steps, di + 1), steps)
+        finished = finished | new_eos
+        if (di + 1) % eos_check_every == 0 and bool(finished.all()):
+            break
+
+    tokens = torch.stack(tokens, 1).tolist()
+    steps = steps.tolist()
+    if return_attentions:
+        return tokens, steps, torch.stack(attentions, 1).cpu()
+    return tokens, steps, None
+
+
+######################################################################
+# Beam search
+# -----------
+#
+# ``beam_search`` keeps ``beam_width`` hypotheses for every sentence. All
+# B x K beams run through the decoder as one batch of rows ``b * K + k``,
+# while the encoder outputs stay a single (B, max_length, H) tensor: the
+# decoder groups the K attention rows of each sentence into one ``bmm``
+# against that sentence's outputs, so they are never copied per beam.
+#
+# Candidates are ranked by their summed log-probability divided by
+# ``length ** length_penalty``, so longer responses are not penalized just
+# for having more terms. A beam that has produced EOS keeps its score and
+# length and only carries itself forward; decoding stops as soon as every
+# beam of every sentence has finished.
+#
+
+def beam_search(encoder, decoder, input_batch, input_lengths, max_length, beam_width=5, length_penalty=1.0,
+                return_attentions=False):
+    # Same return values as greedy_decode, for the best beam of each sentence
+    batch_size = input_batch.size(1)
+    device = input_batch.device
+    K = beam_width
+
+    encoder_outputs, encoder_hidden = encode_batch(encoder, input_batch, input_lengths, max_length)
+
+    decoder_input = torch.full((batch_size * K,), SOS_token, dtype=torch.long, device=device)
+    decoder_hidden = encoder_hidden.repeat_interleave(K, dim=1)
+
+    # only the first beam is live at the start, so the first step does not pick K copies of one word
+    scores = torch.full((batch_size, K), float('-inf'), device=device)
+    scores[:, 0] = 0
+    lengths = torch.zeros(batch_size, K, dtype=torch.long, device=device)
+    finished = torch.zeros(batch_size, K, dtype=torch.bool, device=device)
+    offsets = torch.arange(batch_size, device=device).unsqueeze(1) * K
+    tokens, backpointers, attentions = [], [], []
+
+    for di in range(max_length):
+        decoder_output, decoder_hidden, decoder_attention = decoder(
+            decoder_input, decoder_hidden, encoder_outputs)
+        log_probs = decoder_output.view(batch_size, K, -1)
+        vocab_size = log_probs.size(2)
+
+        # a finished beam can only extend itself with EOS, at no cost
+        log_probs = log_probs.masked_fill(finished.unsqueeze(2), float('-inf'))
+        log_probs[..., EOS_token] = log_probs[..., EOS_token].masked_fill(finished, 0)
+
+        candidates = scores.unsqueeze(2) + log_probs
+        candidate_lengths = (lengths + (~finished).long()).unsqueeze(2)
+        normalized = candidates / candidate_lengths.float() ** length_penalty
+        _, best = normalized.view(batch_size, -1).topk(K, dim=1)
+        beam, token = best // vocab_size, best % vocab_size
+
+        scores = candidates.view(batch_size, -1).gather(1, best)
+        lengths = candidate_lengths.squeeze(2).gather(1, beam)
+        finished = finished.gather(1, beam) | (token == EOS_token)
+
+        rows = (offsets + beam).view(-1)
+        decoder_hidden = decoder_hidden.index_select(1, rows)
+        decoder_input = token.view(-1)
+        tokens.append(token)
+        backpointers.append(beam)
+        if return_attentions:
+            attentions.append(decoder_attention.index_select(0, rows).view(batch_size, K, -1))
+
+        if bool(finished.all()):
+            break
+
+    # pick the best beam by normalized score and follow the backpointers to its start
+    k = (scores / lengths.float() ** length_penalty).argmax(1, keepdim=True)
+    steps = lengths.gather(1, k).squeeze(1)
+    best_tokens, best_attentions = [], []
+    for di in reversed(range(len(tokens))):
+        best_tokens.append(tokens[di].gather(1, k))
+        if return_attentions:
+            best_attentions.append(attentions[di][torch.arange(batch_size, device=device), k[:, 0]])
+        k = backpointers[di].gather(1, k)
+
+    tokens = torch.cat(best_tokens[::-1], 1).tolist()
+    steps = steps.tolist()
+    if return_attentions:
+        return tokens, steps, torch.stack(best_attentions[::-1], 1).cpu()
+    return tokens, steps, None
+
+
+######################################################################
+# Streaming
+# ---------
+#
+# ``stream_decode`` is ``evaluate`` turned into a generator: it yields each
+# word index (with its attention row) as soon as the decoder produces it,
+# so a reply can be shown after one decoder step rather than after the
+# whole sentence. Closing the generator, or simply not asking for the next
+# word, cancels the decode. Like ``evaluate`` it drops the word of the last
+# step when ``max_length`` is reached without EOS, so the words match.
+#
+
+@torch.no_grad()
+def stream_decode(encoder, decoder, input_tensor, max_length):
+    input_length = input_tensor.size(0)
+    encoder_hidden = encoder.initHidden()
+    encoder_output, encoder_hidden = encoder.forward_sequence(input_tensor, encoder_hidden)
+    encoder_outputs = F.pad(encoder_output[:, 0], (0, 0, 0, max_length - input_length))
+
+    decoder_input = torch.tensor([SOS_token], device=input_tensor.device)
+    decoder_hidden = encoder_hidden
+
+    for di in range(max_length - 1):
+        decoder_output, decoder_hidden, decoder_attention = decoder(
+            decoder_input, decoder_hidden, encoder_outputs)
+        decoder_input = decoder_output.argmax(1)
+        index = decoder_input.item()
+        if index == EOS_token:
+            return
+        yield index, decoder_attention[0]
+
+
+######################################################################
+# Shortlisted decoding
+# --------------------
+#
+# ``shortlist_decode`` decodes like ``evaluate`` but scores only the
+# output words in ``candidates`` (sorted indexes, see ``shortlist.py``):
+# the matching rows of ``out`` are gathered once per sentence, and each
+# step multiplies by that small matrix instead of the whole vocabulary.
+# ``log_softmax`` is skipped, since it does not change the argmax. With
+# ``check`` the full projection runs as well, and the steps whose
+# unrestricted argmax is not a candidate are counted.
+#
+
+@torch.no_grad()
+def shortlist_decode(encoder, decoder, input_tensor, max_length, candidates, check=False):
+    # Returns the decoded indexes and attentions as evaluate() does, and the number of misses
+    weight = decoder.out.weight.index_select(0, candidates)
+    bias = decoder.out.bias.index_select(0, candidates)
+
+    input_length = input_tensor.size(0)
+    encoder_hidden = encoder.initHidden()
+    encoder_output, encoder_hidden = encoder.forward_sequence(input_tensor, encoder_hidden)
+    encoder_outputs = F.pad(encoder_output[:, 0], (0, 0, 0, max_length - input_length))
+
+    decoder_input = torch.tensor([SOS_token], device=input_tensor.device)
+    decoder_hidden = encoder_hidden
+
+    decoded, attentions, misses = [], [], 0
+    for di in range(max_length):
+        output, decoder_hidden, decoder_attention = decoder.step(
+            decoder_input, decoder_hidden, encoder_outputs)
+        decoder_input = candidates[F.linear(output, weight, bias).argmax(1)]
+        attentions.append(decoder_attention)
+        if check:
+            full = decoder.out(output).argmax(1)
+            misses += int(not bool((candidates == full).any()))
+        decoded.append(decoder_input.item())
+        if decoded[-1] == EOS_token:
+            break
+
+    return decoded[:-1], torch.cat(attentions).cpu(), misses
+
+
+######################################################################
+# Lean single-sentence decoding
+# -----------------------------
+#
+# ``evaluate`` allocates a ``max_length`` x ``max_length`` attention matrix
+# on every call, pads the encoder outputs into a fresh buffer, builds a new
+# input tensor each step and calls ``.item()`` twice per step. A
+# ``LeanDecoder`` keeps its workspaces between calls instead: the padded
+# encoder outputs, the generated ids (written by ``argmax`` in place, and
+# fed back as the next input without leaving the device) and, only when
+# asked for, the attention rows. EOS is looked for on the device every
+# ``eos_check_every`` steps (see ``eos_interval``), and the ids are read
+# back once at the end.
+#
+# On the CPU the per-step cost is mostly module dispatch, so for a plain
+# decoder in eval mode each step runs ``AttnDecoderRNN.forward``'s math
+# directly on its weights (``_fused_step``): a ``gru_cell`` in place of the
+# one-step ``nn.GRU``, no dropout, and no ``log_softmax``, which does not
+# change the argmax. Decoders in training mode, or with quantized modules,
+# go through ``forward`` as usual. The words are the same as ``evaluate``'s.
+#
+# The workspaces are not shared between threads; ``lean_decoder`` keeps one
+# per decoder module, and makes a new one when ``max_length``,
+# ``eos_check_every`` or the decoder's device changes.
+#
+
+def _fusable(decoder):
+    return (not decoder.training and type(decoder.attn) is nn.Linear and type(decoder.attn_combine) is nn.Linear
+            and type(decoder.out) is nn.Linear and type(decoder.gru) is nn.GRU and decoder.gru.num_layers == 1)
+
+
+def _fused_step(weights, input, hidden, encoder_outputs):
+    embedding, attn_w, attn_b, combine_w, combine_b, w_ih, w_hh, b_ih, b_hh, out_w, out_b = weights
+    embedded = F.embedding(input, embedding)
+    attn_weights = F.softmax(F.linear(torch.cat((embedded, hidden), 1), attn_w, attn_b), dim=1)
+    output = torch.cat((embedded, torch.mm(attn_weights, encoder_outputs)), 1)
+    output = F.relu(F.linear(output, combine_w, combine_b))
+    hidden = torch.gru_cell(output, hidden, w_ih, w_hh, b_ih, b_hh)
+    return F.linear(hidden, out_w, out_b), hidden, attn_weights
+
+
+class LeanDecoder:
+    def __init__(self, hidden_size, max_length, device, eos_check_every=None):
+        self.max_length = max_length
+        self.eos_check_every = eos_interval(eos_check_every, device)
+        self.encoder_outputs = torch.zeros(max_length, hidden_size, device=device)
+        self.tokens = torch.zeros(max_length, dtype=torch.long, device=device)
+        self.sos = torch.full((1,), SOS_token, dtype=torch.long, device=device)
+        self.attentions = None
+
+    @torch.no_grad()
+    def decode(self, encoder, decoder, input_tensor, return_attentions=False):
+        # Returns the decoded ids and, if asked for, the attention rows, as evaluate() does
+        input_length = input_tensor.size(0)
+        encoder_output, encoder_hidden = encoder.forward_sequence(input_tensor, encoder.initHidden())
+        self.encoder_outputs[:input_length].copy_(encoder_output[:, 0])
+        self.encoder_outputs[input_length:].zero_()
+        if return_attentions and self.attentions is None:
+            self.attentions = torch.zeros(self.max_length, self.max_length, device=self.tokens.device)
+
+        fused = _fusable(decoder)
+        if fused:
+            gru = decoder.gru
+            weights = (decoder.embedding.weight, decoder.attn.weight, decoder.attn.bias,
+                       decoder.attn_combine.weight, decoder.attn_combine.bias, gru.weight_ih_l0,
+                       gru.weight_hh_l0, gru.bias_ih_l0, gru.bias_hh_l0, decoder.out.weight, decoder.out.bias)
+            decoder_hidden = encoder_hidden[0]
+        else:
+            decoder_hidden = encoder_hidden
+
+        decoder_input = self.sos
+        for di in range(self.max_length):
+            if fused:
+                decoder_output, decoder_hidden, decoder_attention = _fused_step(
+                    weights, decoder_input, decoder_hidden, self.encoder_outputs)
+            else:
+                decoder_output, decoder_hidden, decoder_attention = decoder(
+                    decoder_input, decoder_hidden, self.encoder_outputs)
+            decoder_input = self.tokens[di:di + 1]
+            torch.argmax(decoder_output, 1, out=decoder_input)
+            if return_attentions:
+                self.attentions[di].copy_(decoder_attention[0])
+            if (di + 1) % self.eos_check_every == 0 and bool((self.tokens[:di + 1] == EOS_token).any()):
+                break
+
+        tokens = self.tokens[:di + 1].tolist()
+        steps = tokens.index(EOS_token) + 1 if EOS_token in tokens else len(tokens)
+        attentions = self.attentions[:steps].to('cpu', copy=True) if return_attentions else None
+        return tokens[:steps - 1], attentions
+
+
+_lean_decoders = weakref.WeakKeyDictionary()
+
+
+def lean_decoder(decoder, max_length, eos_check_every=None):
+    device = decoder.embedding.weight.device
+    settings = (max_length, eos_check_every, device)
+    workspace, workspace_settings = _lean_decoders.get(decoder, (None, None))
+    if workspace is None or workspace_settings != settings:
+        workspace = LeanDecoder(decoder.hidden_size, max_length, device, eos_check_every)
+        _lean_decoders[decoder] = (workspace, settings)
+    return workspace
@@ -0,0 +1,119 @@
+import importlib
+import subprocess
+import sys
+import threading
+
+######################################################################
+# Lazy initialization
+# ===================
+#
+# Importing a model script used to read, normalize, filter and count the
+# whole corpus (``prepareData`` at module level) and to import matplotlib
+# and nltk, even in a process that only wanted ``evaluate`` to serve a
+# saved model. Two context objects put that work off until it is needed:
+#
+# -  ``ChatData`` runs the script's ``prepareData`` the first time
+#    ``pairs`` (or a vocabulary) is asked for. A server can hand it the
+#    vocabularies saved next to the checkpoint (``use_vocab``, see
+#    ``vocab.py``) and never touch the corpus at all.
+# -  ``LazyModule`` stands in for a module and imports it on first
+#    attribute access, so ``plt.figure()`` or
+#    ``bleu_score.sentence_bleu(...)`` pay for the import only when a plot
+#    is drawn or BLEU is computed.
+#
+# ``python lazy.py en_model vi_bot ...`` measures how long importing each
+# script takes on top of ``import torch``, in fresh interpreters.
+#
+
+
+class LazyModule:
+    def __init__(self, name, setup=None):
+        # ``setup(module)`` runs once, right after the import
+        self.__dict__['_name'] = name
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self.__dict__['_module'] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<LazyModule %s%s>' % (self._name, '' if self._module is None else ' (loaded)')
+
+
+class ChatData:
+    def __init__(self, prepare):
+        # ``prepare()`` returns (input_lang, output_lang, pairs), as prepareData does
+        self.prepare = prepare
+        self._langs = None
+        self._pairs = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        with self._lock:
+            if self._pairs is None:
+                input_lang, output_lang, pairs = self.prepare()
+                # vocabularies given to use_vocab stay: the models were trained with them
+                if self._langs is None:
+                    self._langs = (input_lang, output_lang)
+                self._pairs = pairs
+        return self
+
+    def use_vocab(self, input_lang, output_lang):
+        with self._lock:
+            self._langs = (input_lang, output_lang)
+
+    def _lang(self, i):
+        if self._langs is None:
+            self.load()
+        return self._langs[i]
+
+    @property
+    def input_lang(self):
+        return self._lang(0)
+
+    @property
+    def output_lang(self):
+        return self._lang(1)
+
+    @property
+    def pairs(self):
+        return self.load()._pairs
+
+
+_IMPORT_TIMER = '''
+import sys, time
+sys.path.insert(0, '.')
+start = time.perf_counter()
+import torch
+torch_time = time.perf_counter() - start
+start = time.perf_counter()
+import %s
+print(torch_time, time.perf_counter() - start)
+'''
+
+
+def import_time(module, repeats=3):
+    # best of ``repeats`` fresh interpreters: (seconds to import torch, seconds for the rest)
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_TIMER % module], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        times.append(tuple(float(t) for t in output.split('\n')[-2].split()))
+    return min(times, key=lambda t: t[1])
+
+
+if __name__ == '__main__':
+    for module in sys.argv[1:]:
+        torch_time, module_time = import_time(module)
+        print('%-15s import %.3fs on top of torch (torch itself %.3fs)' % (module, module_time, torch_time))
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import re
+
+######################################################################
+# Text normalization
+# ==================
+#
+# Every script lowercases and trims a sentence, puts a space before
+# ``.``, ``!`` and ``?``, drops hyphens, and, depending on the language,
+# replaces every run of other characters with a space:
+#
+#   en  ASCII letters only          (en_model.py)
+#   ru  Cyrillic letters only       (ru_model.py, seq2seq_model.py)
+#   vi  everything is kept          (vi_bot.py, vi_bot2.py)
+#
+# ``PROFILES`` holds those rules with their patterns compiled once, and
+# ``normalize_lines`` runs them over many lines.
+#
+# ``load_normalized`` reads a ``question\answer`` corpus the way
+# ``readLangs`` did, normalizes it, and saves the result under a key made
+# from the file's contents and the profile. The next run reads the saved
+# pairs back and does not normalize again until the file or the rules
+# change.
+#
+
+CACHE_DIR = 'data/cache'
+
+
+class Profile:
+    def __init__(self, name, letters=None):
+        # ``letters`` is the character class kept, None to keep everything
+        self.name = name
+        self.punctuation = re.compile(r"([.!?])")
+        self.other = re.compile(r"[^%s.!?]+" % letters) if letters is not None else None
+        self.key = '%s:%s' % (name, letters)
+
+    def normalize(self, s):
+        # hyphens are dropped first: the two steps never touch the same characters
+        s = self.punctuation.sub(r" \1", s.lower().strip().replace('-', ''))
+        if self.other is not None:
+            s = self.other.sub(" ", s)
+        return s
+
+
+PROFILES = {
+    'en': Profile('en', 'a-zA-Z'),
+    'ru': Profile('ru', 'А-я'),
+    'vi': Profile('vi'),
+}
+
+
+def normalize(s, profile):
+    return PROFILES[profile].normalize(s)
+
+
+def normalize_lines(lines, profile, separator='\\'):
+    # one list of normalized sentences per ``separator``-separated line
+    normalize = PROFILES[profile].normalize
+    return [[normalize(s) for s in line.split(separator)] for line in lines]
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_normalized(path, profile, cache_dir=CACHE_DIR, separator='\\'):
+    # the pairs [normalize(s) for s in line.split(separator)] of every line of ``path``
+    h = hashlib.sha1(file_hash(path).encode('ascii'))
+    h.update(('%s\n%r' % (PROFILES[profile].key, separator)).encode('utf-8'))
+    cache_path = os.path.join(cache_dir, 'normalized-%s.txt' % h.hexdigest()[:16])
+    if os.path.exists(cache_path):
+        # a normalized sentence never contains the separator or a newline
+        with open(cache_path, encoding='utf-8', newline='') as f:
+            return [line.split(separator) for line in f.read().split('\n')]
+
+    print("Normalizing %s (%s)..." % (path, profile))
+    lines = open(path, encoding='utf-8').read().strip().split('\n')
+    pairs = normalize_lines(lines, profile, separator)
+
+    # written under a temporary name and renamed, so readers never see half a file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + '.tmp%d' % os.getpid()
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write('\n'.join(separator.join(pair) for pair in pairs))
+    os.replace(tmp_path, cache_path)
+    return pairs
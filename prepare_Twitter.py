@@ -1,24 +1,76 @@
+import getopt
+import io
+import os
 import re
+import sys
+import time
+from multiprocessing import Pool
 
-file_1 = open('data/Twitter/twitter_ids.tuning tweet.txt', 'r', encoding='utf8')
-file_2 = open('data/Twitter/processed_Twitter.txt', 'w', encoding='utf8')
-file_3 = open('data/Twitter/processed_Twitter_reverse.txt', 'w', encoding='utf8')
-file_4 = open('data/Twitter/twitter_ids.validation tweet.txt', 'r', encoding='utf8')
+######################################################################
+# Twitter triplet preprocessing
+# =============================
+#
+# Every line of the raw files is ``id\tdate\tuser\ttweet``; a line with
+# fewer than four fields (a blank line) ends the conversation. Each tweet
+# becomes the answer to the one before it, with the tweet before that as
+# context, and the pair is written to ``processed_Twitter.txt`` and, the
+# other way round, to ``processed_Twitter_reverse.txt``.
+#
+# Conversations are independent, so a file is cut into byte ranges of about
+# ``chunk_size`` bytes whose boundaries are moved forward to the end of the
+# next blank line. The chunks are cleaned in a process pool and their pairs
+# written back in file order, which gives the same output as reading the
+# file line by line, for files of any size.
+#
 
+INPUT_FILES = ['data/Twitter/twitter_ids.tuning tweet.txt', 'data/Twitter/twitter_ids.validation tweet.txt']
+OUTPUT_FILE = 'data/Twitter/processed_Twitter.txt'
+REVERSE_FILE = 'data/Twitter/processed_Twitter_reverse.txt'
 
-def prepare_data(file_1, file_2, file_3):
-    i = 1
+# mentions, anything but letters, digits and spaces, and links
+CLEAN_PATTERN = re.compile("(@[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)")
+
+
+def is_boundary(line):
+    return len(line.split(b'\t')) < 4
+
+
+def chunk_ranges(path, chunk_size):
+    # (start, end) byte ranges covering the file, each ending after a conversation boundary
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            if f.tell() < size:
+                f.readline()  # finish the line the cut fell into
+                while True:
+                    line = f.readline()
+                    if not line or is_boundary(line):
+                        break
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def prepare_lines(lines):
+    # the pairs of one or more whole conversations, as (forward, reverse, line count)
+    forward = []
+    reverse = []
+    count = 0
     context_1 = '' # context
     context_2 = '' # context
     question = '' # previous line as question
     answer = '' # read one line as answer
     output_question = '' # question with concatenated context
-    while i <= 100000:
-        i += 1
-        data = file_1.readline().split('\t')
+    for line in lines:
+        count += 1
+        data = line.split('\t')
         if len(data) >= 4:
             answer = data[3].strip()
-            answer = ' '.join(re.sub("(@[A-Za-z0-9]+)|([^0-9A-Za-z \t])|(\w+:\/\/\S+)", " ", answer).split())
+            answer = ' '.join(CLEAN_PATTERN.sub(" ", answer).split())
             if len(answer) <=2:
                 continue
         if len(data) < 4:
@@ -36,17 +88,45 @@ def prepare_data(file_1, file_2, file_3):
                     output_question = context_1 + question
             else:
                 output_question = question
-            file_2.write(output_question + '\t' + answer + '\n')
-            file_3.write(answer + '\t' + question + '\n')
-        else:
-            pass
+            forward.append(output_question + '\t' + answer + '\n')
+            reverse.append(answer + '\t' + question + '\n')
         #context_2 = context_1 # disable to use only one context
         context_1 = question
         question = answer
+    return ''.join(forward), ''.join(reverse), count
+
+
+def prepare_chunk(task):
+    path, start, end = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # universal newlines, as when the file is opened in text mode
+    return prepare_lines(io.StringIO(data.decode('utf8'), newline=None))
+
+
+def prepare_data(input_files=INPUT_FILES, output_file=OUTPUT_FILE, reverse_file=REVERSE_FILE,
+                 workers=None, chunk_size=8 * 2 ** 20):
+    tasks = [(path, start, end) for path in input_files for start, end in chunk_ranges(path, chunk_size)]
+    lines = 0
+    start_time = time.perf_counter()
+    with open(output_file, 'w', encoding='utf8') as out, open(reverse_file, 'w', encoding='utf8') as out_reverse, \
+            Pool(workers) as pool:
+        # imap keeps the chunks in file order
+        for forward, reverse, count in pool.imap(prepare_chunk, tasks):
+            out.write(forward)
+            out_reverse.write(reverse)
+            lines += count
+    elapsed = time.perf_counter() - start_time
+    print('%d lines in %d chunks, %.1fs (%.0f lines/s)' % (lines, len(tasks), elapsed,
+                                                          lines / elapsed if elapsed else 0.0))
+    return lines
 
-prepare_data(file_1, file_2, file_3)
-prepare_data(file_4, file_2, file_3)
 
-file_1.close()
-file_2.close()
-file_3.close()
+if __name__ == '__main__':
+    # python prepare_Twitter.py [--workers=N] [--chunk-mb=N] [input files...]
+    opts, args = getopt.getopt(sys.argv[1:], '', ['workers=', 'chunk-mb='])
+    opts = dict(opts)
+    prepare_data(args or INPUT_FILES,
+                 workers=int(opts['--workers']) if '--workers' in opts else None,
+                 chunk_size=int(float(opts.get('--chunk-mb', 8)) * 2 ** 20))
@@ -0,0 +1,62 @@
+import copy
+import io
+import time
+import torch
+import torch.nn as nn
+
+######################################################################
+# Dynamic int8 quantization
+# =========================
+#
+# On CPU, decoding time goes almost entirely to the GRUs and to the
+# ``attn``, ``attn_combine`` and vocabulary-sized ``out`` projections.
+# ``quantize_models`` swaps those modules for dynamically quantized ones:
+# weights are stored as int8, and activations are quantized on the fly for
+# each matmul, so no calibration data is needed. The embeddings stay fp32.
+#
+# Only the inference paths (``forward``/``forward_sequence`` and
+# ``AttnDecoderRNN.forward``) are supported; ``forward_teacher`` slices the
+# float ``attn`` weights and is for training.
+#
+
+
+def quantize_models(encoder, decoder, dtype=torch.qint8):
+    # int8 copies of the encoder and decoder in eval mode; the originals are untouched
+    encoder = torch.quantization.quantize_dynamic(copy.deepcopy(encoder).cpu().eval(), {nn.GRU, nn.Linear}, dtype)
+    decoder = torch.quantization.quantize_dynamic(copy.deepcopy(decoder).cpu().eval(), {nn.GRU, nn.Linear}, dtype)
+    return encoder, decoder
+
+
+def model_size(*modules):
+    # serialized size of the weights, in bytes
+    size = 0
+    for module in modules:
+        buffer = io.BytesIO()
+        torch.save(module.state_dict(), buffer)
+        size += buffer.tell()
+    return size
+
+
+def reply_latency(evaluate, encoder, decoder, sentences, repeats=1):
+    # mean seconds per reply of ``evaluate(encoder, decoder, sentence)``
+    evaluate(encoder, decoder, sentences[0])  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for sentence in sentences:
+            evaluate(encoder, decoder, sentence)
+    return (time.perf_counter() - start) / (repeats * len(sentences))
+
+
+def compare_models(evaluate, bleu, fp32_models, int8_models, sentences):
+    # Latency, size and BLEU of the int8 models against the fp32 ones.
+    # ``bleu(encoder, decoder)`` must score both on the same held-out pairs.
+    report = {}
+    for name, (encoder, decoder) in (('fp32', fp32_models), ('int8', int8_models)):
+        report[name] = dict(latency_ms=reply_latency(evaluate, encoder, decoder, sentences) * 1000,
+                            size_mb=model_size(encoder, decoder) / 2 ** 20,
+                            bleu=bleu(encoder, decoder))
+    for key in ('latency_ms', 'size_mb', 'bleu'):
+        print('%-10s fp32 %10.4f  int8 %10.4f  (%+.1f%%)' % (
+            key, report['fp32'][key], report['int8'][key],
+            (report['int8'][key] / report['fp32'][key] - 1) * 100 if report['fp32'][key] else 0.0))
+    return report
@@ -0,0 +1,105 @@
+import hashlib
+import io
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import torch
+
+######################################################################
+# Response cache
+# ==============
+#
+# Chat traffic is dominated by a few greetings, yet every request used to
+# run the encoder and decoder again. With the models in eval mode greedy
+# decoding is deterministic, so ``ResponseCache`` keeps the latest answers
+# in an LRU map keyed by the normalized sentence, one map per model.
+#
+# A model is identified by a version token fixed when its weights are
+# loaded: ``register`` takes an explicit one (a checkpoint step, say) or
+# hashes the serialized state dicts (``state_version``). Modules seen for the
+# first time are registered on the spot, so a ``torch.load``-ed checkpoint
+# gets a version of its own. Weights loaded into modules that are already
+# registered need ``register`` again. Switching between models does not
+# drop anything: each keeps its own entries, and the ``max_models`` most
+# recently used models are kept.
+#
+
+
+def state_version(*modules):
+    h = hashlib.sha1()
+    for module in modules:
+        buffer = io.BytesIO()
+        torch.save(module.state_dict(), buffer)
+        h.update(buffer.getvalue())
+    return h.hexdigest()[:16]
+
+
+class ResponseCache:
+    def __init__(self, maxsize=4096, ttl=None, max_models=4):
+        self.maxsize = maxsize  # entries per model
+        self.ttl = ttl  # seconds an entry stays valid, None for no limit
+        self.max_models = max_models
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()  # version -> OrderedDict of sentence -> (response, time)
+        self._versions = weakref.WeakKeyDictionary()  # module -> version token
+        self._lock = threading.Lock()
+
+    def register(self, *modules, version=None):
+        # version token of the modules, recorded for ``model_version``
+        if version is None:
+            version = state_version(*modules)
+        with self._lock:
+            for module in modules:
+                self._versions[module] = version
+        return version
+
+    def model_version(self, *modules):
+        with self._lock:
+            versions = [self._versions.get(module) for module in modules]
+        if None in versions:
+            return self.register(*modules)
+        return versions[0] if len(set(versions)) == 1 else tuple(versions)
+
+    def get(self, sentence, version):
+        # cached response, or None
+        with self._lock:
+            entries = self._models.get(version)
+            entry = entries.get(sentence) if entries is not None else None
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del entries[sentence]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._models.move_to_end(version)
+            entries.move_to_end(sentence)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, sentence, version, response):
+        with self._lock:
+            entries = self._models.get(version)
+            if entries is None:
+                entries = self._models[version] = OrderedDict()
+            self._models.move_to_end(version)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            entries[sentence] = (response, time.time())
+            entries.move_to_end(sentence)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._models.values())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self), models=len(self._models), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
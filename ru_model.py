@@ -1,19 +1,40 @@
 from __future__ import unicode_literals, print_function, division
 from io import open
-import re
 import sys
 import getopt
 import random
-from nltk.translate.bleu_score import sentence_bleu
 import torch
 import torch.nn as nn
 from torch import optim
 import torch.nn.functional as F
+from batching import pad_sequences, train_batch
+from inference import greedy_decode, beam_search, stream_decode, shortlist_decode, lean_decoder
+from response_cache import ResponseCache
+from chat_server import serve
+from export import export_models
+from quantization import quantize_models, compare_models
+from shortlist import Shortlist
+from sampler import BucketBatchSampler
+from corpus_cache import load_corpus
+from data_loader import make_loader, cycle
+from distributed import train_distributed
+from checkpoint import CheckpointWriter, load_latest, restore_training_state, training_state
+from normalization import normalize
+from binary_corpus import BinaryCorpus, open_corpus
+from vocab import save_vocab, load_vocab, has_vocab, corpus_settings
+from lazy import LazyModule, ChatData
+from dedup import deduplicate, print_report, split_held_out
 import warnings
 warnings.filterwarnings("ignore")
 
+# imported on first use (see lazy.py)
+bleu_score = LazyModule('nltk.translate.bleu_score')
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(device)
+
+# weights, checkpoints and the saved vocabulary all live here
+MODEL_DIR = 'model/RU-model'
 ######################################################################
 # Loading data files
 # ==================
@@ -93,12 +114,11 @@ class Lang:
 # Lowercase, trim, and remove non-letter characters
 
 
+NORMALIZATION = 'ru'  # profile in normalization.py
+
+
 def normalizeString(s):
-    s = s.lower().strip()
-    s = re.sub(r"([.!?])", r" \1", s)
-    s = re.sub(r"([-])", r"", s)
-    s = re.sub(r"[^А-я.!?]+", r" ", s)
-    return s
+    return normalize(s, NORMALIZATION)
 
 
 ######################################################################
@@ -117,10 +137,11 @@ def readLangs(reverse=False):
     #     lines = open('data/Twitter/processed_Twitter_reverse.txt', encoding='utf-8').read().strip().split('\n')
     # else:
     #     #lines = open('data/OpenSubtitles/processed_OpenSubtitles.txt', encoding='utf-8').read().strip().split('\n')
-    lines = open('data/answer_databse.txt', encoding='utf-8').read().strip().split('\n')
+    corpus_file = 'data/answer_databse.txt'
 
-    # Split every line into pairs and normalize
-    pairs = [[normalizeString(s) for s in l.split('\\')] for l in lines]
+    # Split every line into pairs and normalize (cached between runs), or
+    # open the binary corpus made by binary_corpus.py
+    pairs = open_corpus(corpus_file, NORMALIZATION)
 
     # if reverse:
     #     input_lang = Lang('Answer')
@@ -154,6 +175,9 @@ def filterPair(p):
 
 
 def filterPairs(pairs):
+    if isinstance(pairs, BinaryCorpus):
+        # lengths come from the offsets, only the pairs kept are decoded
+        return [pairs[i] for i in pairs.filter_lengths(MAX_LENGTH).tolist()]
     #tmp =[pair for pair in pairs if filterPair(pair)]
     #lst = filter(lambda pair: filterPair(pair), pairs)
     lst = [None]* len(pairs)
@@ -167,10 +191,12 @@ def filterPairs(pairs):
 #
 # -  Read text file and split into lines, split lines into pairs
 # -  Normalize text, filter by length and content
+# -  Drop repeated pairs, and optionally near-duplicates and overly
+#    frequent responses
 # -  Make word lists from sentences in pairs
 #
 
-def prepareData(reverse=False):
+def prepareData(reverse=False, dedup=True, near_duplicates=False, max_response_count=None):
     input_lang, output_lang, pairs = readLangs(reverse)
     print("Read %s sentence pairs" % len(pairs))
     for x in range(0, len(pairs)):
@@ -178,6 +204,10 @@ def prepareData(reverse=False):
             print (x)
     pairs = filterPairs(pairs)
     print("Trimmed to %s sentence pairs" % len(pairs))
+    if dedup:
+        # repeated exchanges are dropped before the words are counted (see dedup.py)
+        pairs, report = deduplicate(pairs, near_duplicates=near_duplicates, max_response_count=max_response_count)
+        print_report(report)
     print("Counting words...")
     for pair in pairs:
         input_lang.addSentence(pair[0])
@@ -189,8 +219,27 @@ def prepareData(reverse=False):
     return input_lang, output_lang, pairs
 
 
-input_lang, output_lang, pairs = prepareData(True)
-#print(random.choice(pairs))
+# Deduplication changes the pairs, and with them the word indexes, so the
+# pairs are prepared with the settings the saved vocabulary records (see
+# ``vocab.py``): an existing model keeps its indexes, a new one is trained
+# on deduplicated pairs
+def corpusSettings():
+    settings = dict(dedup=True, near_duplicates=False, max_response_count=None)
+    settings.update(corpus_settings(MODEL_DIR))
+    return settings
+
+
+# The corpus is read, and the vocabularies counted, the first time
+# ``chat_data.pairs`` or a vocabulary is needed, not at import
+chat_data = ChatData(lambda: prepareData(True, **corpusSettings()))
+#print(random.choice(chat_data.pairs))
+
+
+def __getattr__(name):
+    # input_lang, output_lang and pairs used to be module globals
+    if name in ('input_lang', 'output_lang', 'pairs'):
+        return getattr(chat_data, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 ######################################################################
@@ -255,15 +304,27 @@ class EncoderRNN(nn.Module):
 
 
     def forward(self, input, hidden):
-        embedded = self.embedding(input).view(1, 1, -1)
+        embedded = self.embedding(input).view(1, -1, self.hidden_size)
         output = embedded
         output, hidden = self.gru(output, hidden)
         #output, hidden = self.gru_1(output, hidden)
         #output, hidden = self.gru_2(output, hidden)
         return output, hidden
 
-    def initHidden(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+    def forward_sequence(self, input, hidden, lengths=None):
+        # Encode a whole (T, B) input in a single GRU call. With ``lengths``
+        # the padded batch is packed, so each sequence's hidden state stops
+        # at its last real token and padded outputs come back as zeros.
+        embedded = self.embedding(input.view(input.size(0), -1))
+        if lengths is not None:
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, lengths.cpu(), enforce_sorted=False)
+        output, hidden = self.gru(embedded, hidden)
+        if lengths is not None:
+            output, _ = nn.utils.rnn.pad_packed_sequence(output, total_length=input.size(0))
+        return output, hidden
+
+    def initHidden(self, batch_size=1):
+        return torch.zeros(1, batch_size, self.hidden_size, device=device)
 
 ######################################################################
 # The Decoder
@@ -287,14 +348,14 @@ class DecoderRNN(nn.Module):
         self.softmax = nn.LogSoftmax(dim=1)
 
     def forward(self, input, hidden):
-        output = self.embedding(input).view(1, 1, -1)
+        output = self.embedding(input).view(1, -1, self.hidden_size)
         output = F.relu(output)
         output, hidden = self.gru(output, hidden)
         output = self.softmax(self.out(output[0]))
         return output, hidden
 
-    def initHidden(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+    def initHidden(self, batch_size=1):
+        return torch.zeros(1, batch_size, self.hidden_size, device=device)
 
 ######################################################################
 # I encourage you to train and observe the results of this model, but to
@@ -322,16 +383,22 @@ class AttnDecoderRNN(nn.Module):
         #self.gru_2 = nn.GRU(self.hidden_size, self.hidden_size)
         self.out = nn.Linear(self.hidden_size, self.output_size)
 
-    def forward(self, input, hidden, encoder_outputs):
-        embedded = self.embedding(input).view(1, 1, -1)
+    def step(self, input, hidden, encoder_outputs):
+        # One decoder step up to the GRU output, before the vocabulary projection
+        embedded = self.embedding(input).view(1, -1, self.hidden_size)
         embedded = self.dropout(embedded)
 
         attn_weights = F.softmax(
             self.attn(torch.cat((embedded[0], hidden[0]), 1)), dim=1)
-        attn_applied = torch.bmm(attn_weights.unsqueeze(0),
-                                 encoder_outputs.unsqueeze(0))
-
-        output = torch.cat((embedded[0], attn_applied[0]), 1)
+        # encoder_outputs is (max_length, H) for one sentence, (B, max_length, H) for a batch.
+        # With beam search there are K rows per sentence; they are grouped so
+        # each sentence's outputs are shared by its beams instead of copied.
+        if encoder_outputs.dim() == 2:
+            encoder_outputs = encoder_outputs.unsqueeze(0)
+        attn_applied = torch.bmm(attn_weights.view(encoder_outputs.size(0), -1, attn_weights.size(1)),
+                                 encoder_outputs)
+
+        output = torch.cat((embedded[0], attn_applied.view(-1, self.hidden_size)), 1)
         output = self.attn_combine(output).unsqueeze(0)
 
         output = F.relu(output)
@@ -339,11 +406,44 @@ class AttnDecoderRNN(nn.Module):
         #output, hidden = self.gru_1(output, hidden)
         #output, hidden = self.gru_2(output, hidden)
 
-        output = F.log_softmax(self.out(output[0]), dim=1)
+        return output[0], hidden, attn_weights
+
+    def forward(self, input, hidden, encoder_outputs):
+        output, hidden, attn_weights = self.step(input, hidden, encoder_outputs)
+        output = F.log_softmax(self.out(output), dim=1)
         return output, hidden, attn_weights
 
-    def initHidden(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+    def forward_teacher(self, target, hidden, encoder_outputs):
+        # Teacher-forced pass over a whole (T, B) target. The step inputs are
+        # SOS followed by target[:-1], so the embedding, dropout and the
+        # embedding halves of ``attn``/``attn_combine`` run once for every
+        # step; only the attention over the hidden state and the GRU
+        # recurrence loop over time, and ``out`` projects all T x B positions
+        # in one matmul.
+        inputs = torch.cat((torch.full_like(target[:1], SOS_token), target[:-1]), 0)
+        embedded = self.dropout(self.embedding(inputs.view(target.size(0), -1)))
+        if encoder_outputs.dim() == 2:
+            encoder_outputs = encoder_outputs.unsqueeze(0)
+
+        H = self.hidden_size
+        attn_embedded = F.linear(embedded, self.attn.weight[:, :H], self.attn.bias)
+        combine_embedded = F.linear(embedded, self.attn_combine.weight[:, :H], self.attn_combine.bias)
+
+        outputs = []
+        for di in range(target.size(0)):
+            attn_weights = F.softmax(
+                attn_embedded[di] + F.linear(hidden[0], self.attn.weight[:, H:]), dim=1)
+            attn_applied = torch.bmm(attn_weights.unsqueeze(1), encoder_outputs)
+            output = combine_embedded[di] + F.linear(attn_applied[:, 0], self.attn_combine.weight[:, H:])
+            output = F.relu(output).unsqueeze(0)
+            output, hidden = self.gru(output, hidden)
+            outputs.append(output[0])
+
+        output = F.log_softmax(self.out(torch.stack(outputs)), dim=2)
+        return output, hidden
+
+    def initHidden(self, batch_size=1):
+        return torch.zeros(1, batch_size, self.hidden_size, device=device)
 
 
 ######################################################################
@@ -375,11 +475,29 @@ def tensorFromSentence(lang, sentence):
 
 
 def tensorsFromPair(pair):
-    input_tensor = tensorFromSentence(input_lang, pair[0])
-    target_tensor = tensorFromSentence(output_lang, pair[1])
+    input_tensor = tensorFromSentence(chat_data.input_lang, pair[0])
+    target_tensor = tensorFromSentence(chat_data.output_lang, pair[1])
     return (input_tensor, target_tensor)
 
 
+# A share of the pairs, picked by hash (see ``dedup.py``), is never trained
+# on, so BLEU can be measured on pairs the models have not seen
+HELD_OUT_FRACTION = 0.02
+
+
+def trainingPairs():
+    return split_held_out(chat_data.pairs, HELD_OUT_FRACTION)[0]
+
+
+def heldOutPairs():
+    return split_held_out(chat_data.pairs, HELD_OUT_FRACTION)[1]
+
+
+def loadCorpus():
+    # Token ids of every training pair, tokenized once and cached on disk
+    return load_corpus(trainingPairs(), chat_data.input_lang, chat_data.output_lang, indexesFromSentence)
+
+
 ######################################################################
 # Training the Model
 # ------------------
@@ -419,14 +537,11 @@ def train(input_tensor, target_tensor, encoder, decoder, encoder_optimizer, deco
     input_length = input_tensor.size(0)
     target_length = target_tensor.size(0)
 
-    encoder_outputs = torch.zeros(max_length, encoder.hidden_size, device=device)
-
     loss = 0
 
-    for ei in range(input_length):
-        encoder_output, encoder_hidden = encoder(
-            input_tensor[ei], encoder_hidden)
-        encoder_outputs[ei] = encoder_output[0, 0]
+    # One GRU call over the whole input instead of one per token
+    encoder_output, encoder_hidden = encoder.forward_sequence(input_tensor, encoder_hidden)
+    encoder_outputs = F.pad(encoder_output[:, 0], (0, 0, 0, max_length - input_length))
 
     decoder_input = torch.tensor([[SOS_token]], device=device)
 
@@ -435,12 +550,11 @@ def train(input_tensor, target_tensor, encoder, decoder, encoder_optimizer, deco
     use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
 
     if use_teacher_forcing:
-        # Teacher forcing: Feed the target as the next input
-        for di in range(target_length):
-            decoder_output, decoder_hidden, decoder_attention = decoder(
-                decoder_input, decoder_hidden, encoder_outputs)
-            loss += criterion(decoder_output, target_tensor[di])
-            decoder_input = target_tensor[di]  # Teacher forcing
+        # Teacher forcing: Feed the target as the next input, with a single
+        # output projection and loss over the whole target
+        decoder_output, decoder_hidden = decoder.forward_teacher(
+            target_tensor, decoder_hidden, encoder_outputs)
+        loss = criterion(decoder_output.view(-1, decoder.output_size), target_tensor.view(-1)) * target_length
 
     else:
         # Without teacher forcing: use its own predictions as the next input
@@ -497,7 +611,9 @@ def timeSince(since, percent):
 # of examples, time so far, estimated time) and average loss.
 #
 
-def trainIters(encoder, decoder, n_iters, print_every=1000, plot_every=100, learning_rate=0.001): # lr =0.01 -> 0.001 -> 0.0005
+def trainIters(encoder, decoder, n_iters, print_every=1000, plot_every=100, learning_rate=0.001, batch_size=1,
+               max_tokens=None, seed=0, num_workers=0, checkpoint_every=None,
+               resume=False): # lr =0.01 -> 0.001 -> 0.0005
     start = time.time()
     plot_losses = []
     all_losses = [] # Use to calculate perplexity
@@ -508,14 +624,73 @@ def trainIters(encoder, decoder, n_iters, print_every=1000, plot_every=100, lear
     decoder_optimizer = optim.Adam(decoder.parameters(), lr=learning_rate) #SGD , weight_decay=1e-6
     #training_pairs = [tensorsFromPair(random.choice(pairs)) for i in range(n_iters)]
     criterion = nn.NLLLoss()
-
-    for iter in range(1, n_iters + 1):
-        training_pair = tensorsFromPair(random.choice(pairs)) #training_pairs[iter - 1]
-        input_tensor = training_pair[0]
-        target_tensor = training_pair[1]
-
-        loss = train(input_tensor, target_tensor, encoder,
-                     decoder, encoder_optimizer, decoder_optimizer, criterion)
+    corpus = loadCorpus()
+    # weights are written on a background thread; with checkpoint_every (seconds)
+    # they are saved on a wall-clock cadence instead of every print_every iterations
+    checkpoints = CheckpointWriter(MODEL_DIR, every_seconds=checkpoint_every)
+    # the word indexes the weights are trained with go next to them (see
+    # vocab.py); a resumed run must still be counting the same corpus
+    if resume and has_vocab(checkpoints.directory):
+        load_vocab(checkpoints.directory, Lang, chat_data.pairs, encoder, decoder, corpus=corpusSettings())
+    save_vocab(checkpoints.directory, chat_data.input_lang, chat_data.output_lang, chat_data.pairs, corpus=corpusSettings())
+
+    # resume continues from the latest checkpoint: weights, Adam moments,
+    # RNG states, iteration count, loss history and sampler position
+    start_iter = 1
+    epoch, epoch_batches = 0, 0
+    state = load_latest(checkpoints.directory) if resume else None
+    if state is not None:
+        metrics = restore_training_state(state, encoder, decoder, encoder_optimizer, decoder_optimizer)
+        start_iter = state['step'] + 1
+        all_losses = metrics.get('all_losses', [])
+        plot_losses = metrics.get('plot_losses', [])
+        print_loss_total = metrics.get('print_loss_total', 0)
+        plot_loss_total = metrics.get('plot_loss_total', 0)
+        epoch, epoch_batches = metrics.get('epoch', 0), metrics.get('epoch_batches', 0)
+        print('Resuming from iteration %d' % start_iter)
+
+    # until a new step runs, the perplexity is that of the restored losses
+    perplexity = 2 ** (np.mean(all_losses)) if all_losses else float('nan')
+    if start_iter > n_iters:
+        # the latest checkpoint already covers n_iters: nothing to train or save
+        print('Checkpoint at iteration %d already covers %d iterations' % (start_iter - 1, n_iters))
+        checkpoints.close()
+        return perplexity
+
+    # Batched training walks the corpus in length-bucketed epochs instead of
+    # sampling single pairs with replacement
+    sampler = None
+    if batch_size > 1 or max_tokens:
+        sampler = BucketBatchSampler(corpus.lengths(), batch_size, max_tokens, seed=seed)
+        sampler.set_epoch(epoch, epoch_batches)
+    # with num_workers > 0, worker processes prepare batches while the model trains
+    batches = cycle(make_loader(corpus, sampler, max(1, n_iters - start_iter + 1), num_workers,
+                                 seed=seed + start_iter))
+    data_wait_total = 0  # Reset every print_every
+
+    def saveCheckpoint(iter):
+        checkpoints.save(encoder, decoder, iter, **training_state(
+            encoder_optimizer, decoder_optimizer, all_losses=all_losses, plot_losses=plot_losses,
+            print_loss_total=print_loss_total, plot_loss_total=plot_loss_total,
+            epoch=epoch, epoch_batches=epoch_batches))
+
+    for iter in range(start_iter, n_iters + 1):
+        data_start = time.time()
+        batch = next(batches)
+        data_wait_total += time.time() - data_start
+
+        if sampler is not None:
+            if sampler.epoch != epoch:
+                epoch, epoch_batches = sampler.epoch, 0
+            epoch_batches += 1
+            # one length-bucketed batch per optimizer step, padded to (T, B) with a masked loss
+            input_batch, input_lengths, target_batch, target_lengths = [t.to(device) for t in batch]
+            loss = train_batch(input_batch, input_lengths, target_batch, target_lengths, encoder,
+                               decoder, encoder_optimizer, decoder_optimizer, teacher_forcing_ratio)
+        else:
+            input_tensor, target_tensor = [t.to(device) for t in batch]
+            loss = train(input_tensor, target_tensor, encoder,
+                         decoder, encoder_optimizer, decoder_optimizer, criterion)
         all_losses.append(loss)
         print_loss_total += loss
         plot_loss_total += loss
@@ -525,8 +700,15 @@ def trainIters(encoder, decoder, n_iters, print_every=1000, plot_every=100, lear
             print_loss_total = 0
             print('%s (%d %d%%) %.4f' % (timeSince(start, iter / n_iters),
                                          iter, iter / n_iters * 100, print_loss_avg))
-            torch.save(encoder, 'model/encoder.pkl')
-            torch.save(decoder, 'model/decoder.pkl')
+            if sampler is not None:
+                print('epoch %d, padding efficiency %.1f%%' % (sampler.epoch, sampler.padding_efficiency() * 100))
+            print('waiting on data %.2f ms/step' % (data_wait_total * 1000 / print_every))
+            data_wait_total = 0
+            if checkpoint_every is None:
+                saveCheckpoint(iter)
+
+        if checkpoints.due():
+            saveCheckpoint(iter)
 
         if iter % plot_every == 0:
             plot_loss_avg = plot_loss_total / plot_every
@@ -535,6 +717,8 @@ def trainIters(encoder, decoder, n_iters, print_every=1000, plot_every=100, lear
 
         perplexity = 2 ** (np.mean(all_losses)) # Not sure if the formular is correct, base =2 or e?
 
+    saveCheckpoint(n_iters)
+    checkpoints.close()
     showPlot(plot_losses)
     return perplexity
 
@@ -547,9 +731,9 @@ def trainIters(encoder, decoder, n_iters, print_every=1000, plot_every=100, lear
 # ``plot_losses`` saved while training.
 #
 
-import matplotlib.pyplot as plt
-plt.switch_backend('agg')
-import matplotlib.ticker as ticker
+# matplotlib is imported the first time a plot is drawn
+plt = LazyModule('matplotlib.pyplot', setup=lambda plt: plt.switch_backend('agg'))
+ticker = LazyModule('matplotlib.ticker')
 import numpy as np
 
 
@@ -575,18 +759,14 @@ def showPlot(points):
 
 def evaluate(encoder, decoder, sentence, max_length=MAX_LENGTH):
     with torch.no_grad():
-        input_tensor = tensorFromSentence(input_lang, sentence)
+        input_tensor = tensorFromSentence(chat_data.input_lang, sentence)
         if input_tensor.size()[0] > 50:
             input_tensor = input_tensor[:50]
         input_length = input_tensor.size()[0]
         encoder_hidden = encoder.initHidden()
 
-        encoder_outputs = torch.zeros(max_length, encoder.hidden_size, device=device)
-
-        for ei in range(input_length):
-            encoder_output, encoder_hidden = encoder(input_tensor[ei],
-                                                     encoder_hidden)
-            encoder_outputs[ei] += encoder_output[0, 0]
+        encoder_output, encoder_hidden = encoder.forward_sequence(input_tensor, encoder_hidden)
+        encoder_outputs = F.pad(encoder_output[:, 0], (0, 0, 0, max_length - input_length))
 
         decoder_input = torch.tensor([[SOS_token]], device=device)  # SOS
 
@@ -604,24 +784,98 @@ def evaluate(encoder, decoder, sentence, max_length=MAX_LENGTH):
                 decoded_words.append('<EOS>')
                 break
             else:
-                decoded_words.append(output_lang.index2word[topi.item()])
+                decoded_words.append(chat_data.output_lang.index2word[topi.item()])
 
             decoder_input = topi.squeeze().detach()
 
         return decoded_words[:-1], decoder_attentions[:di + 1]
 
 
+######################################################################
+# ``evaluate_batch`` gives the same result as calling ``evaluate`` on each
+# sentence, but encodes and decodes them all as one padded batch (see
+# ``inference.py``), so throughput grows with the batch size instead of
+# paying a sync per generated word. With ``beam_width`` > 1 it runs a
+# batched beam search instead of greedy decoding.
+#
+
+def evaluate_batch(encoder, decoder, sentences, max_length=MAX_LENGTH, return_attentions=False,
+                   beam_width=1, length_penalty=1.0, eos_check_every=None):
+    with torch.no_grad():
+        indexes = [(indexesFromSentence(chat_data.input_lang, sentence) + [EOS_token])[:50] for sentence in sentences]
+        input_batch, input_lengths = pad_sequences(indexes, device)
+        if beam_width > 1:
+            tokens, steps, attentions = beam_search(encoder, decoder, input_batch, input_lengths, max_length,
+                                                    beam_width, length_penalty, return_attentions)
+        else:
+            tokens, steps, attentions = greedy_decode(encoder, decoder, input_batch, input_lengths,
+                                                      max_length, return_attentions, eos_check_every)
+
+    results = []
+    for b in range(len(sentences)):
+        # like evaluate(), drop the last step: the EOS, or the final word
+        # when max_length was reached first
+        decoded_words = [chat_data.output_lang.index2word[index] for index in tokens[b][:steps[b] - 1]]
+        results.append((decoded_words, attentions[b, :steps[b]] if return_attentions else None))
+    return results
+
+
+######################################################################
+# ``evaluate_stream`` yields the words of ``evaluate`` one at a time as
+# they are decoded, with their attention rows if ``return_attentions`` is
+# set, so a reply can be printed or sent before it is complete. Closing
+# the generator (or breaking out of the loop) cancels the rest.
+#
+
+def evaluate_stream(encoder, decoder, sentence, max_length=MAX_LENGTH, return_attentions=False):
+    input_tensor = tensorFromSentence(chat_data.input_lang, sentence)[:50]
+    for index, attention in stream_decode(encoder, decoder, input_tensor, max_length):
+        word = chat_data.output_lang.index2word[index]
+        yield (word, attention) if return_attentions else word
+
+
+######################################################################
+# ``evaluate_shortlist`` is ``evaluate`` with the output projection
+# restricted to a vocabulary ``Shortlist`` built from the training pairs.
+# With ``check`` it also records how often the full-vocabulary argmax fell
+# outside the shortlist.
+#
+
+def evaluate_shortlist(encoder, decoder, sentence, shortlist, max_length=MAX_LENGTH, check=False):
+    input_tensor = tensorFromSentence(chat_data.input_lang, sentence)[:50]
+    candidates = shortlist.candidates(input_tensor.view(-1).tolist(), device)
+    indexes, attentions, misses = shortlist_decode(encoder, decoder, input_tensor, max_length, candidates, check)
+    if check:
+        shortlist.record(attentions.size(0), misses)
+    return [chat_data.output_lang.index2word[index] for index in indexes], attentions
+
+
+######################################################################
+# ``evaluate_lean`` returns the same words as ``evaluate`` with less
+# overhead per reply: it decodes into workspaces kept per decoder, checks
+# for EOS on the device every few steps instead of calling ``.item()`` on
+# each one, and records attention only when ``return_attentions`` is set
+# (see ``LeanDecoder`` in ``inference.py``).
+#
+
+def evaluate_lean(encoder, decoder, sentence, max_length=MAX_LENGTH, return_attentions=False):
+    input_tensor = tensorFromSentence(chat_data.input_lang, sentence)[:50]
+    indexes, attentions = lean_decoder(decoder, max_length).decode(encoder, decoder, input_tensor,
+                                                                   return_attentions)
+    return [chat_data.output_lang.index2word[index] for index in indexes], attentions
+
+
 ######################################################################
 # We can evaluate random sentences from the training set and print out the
 # input, target, and output to make some subjective quality judgements:
 #
 
 def evaluateRandomly(encoder, decoder, n=10):
-    for i in range(n):
-        pair = random.choice(pairs)
+    sample = [random.choice(chat_data.pairs) for i in range(n)]
+    outputs = evaluate_batch(encoder, decoder, [pair[0] for pair in sample])
+    for pair, (output_words, attentions) in zip(sample, outputs):
         print('>', pair[0])
         print('=', pair[1])
-        output_words, attentions = evaluate(encoder, decoder, pair[0])
         output_sentence = ' '.join(output_words)
         print('<', output_sentence)
         print('')
@@ -646,16 +900,21 @@ def evaluateRandomly(encoder, decoder, n=10):
 #    encoder and decoder are initialized and run ``trainIters`` again.
 #
 
-def run_train(iterations):
+def run_train(iterations, batch_size=1, max_tokens=None, num_workers=0, resume=False):
     hidden_size = 512 # original 256 for single layer
     try:
-        encoder1 = torch.load('model/Ru-model/encoder.pkl')
-        attn_decoder1 = torch.load('model/Ru-model/decoder.pkl')
+        encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+        attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
     except:
-        encoder1 = EncoderRNN(input_lang.n_words, hidden_size).to(device)
-        attn_decoder1 = AttnDecoderRNN(hidden_size, output_lang.n_words, dropout_p=0.1).to(device)
+        encoder1 = EncoderRNN(chat_data.input_lang.n_words, hidden_size).to(device)
+        attn_decoder1 = AttnDecoderRNN(hidden_size, chat_data.output_lang.n_words, dropout_p=0.1).to(device)
+    else:
+        # continuing from saved weights: they must have been trained on this corpus
+        if has_vocab(MODEL_DIR):
+            load_vocab(MODEL_DIR, Lang, chat_data.pairs, encoder1, attn_decoder1, corpus=corpusSettings())
 
-    perplexity = trainIters(encoder1, attn_decoder1, iterations, print_every=500, learning_rate=0.000001) #5000
+    perplexity = trainIters(encoder1, attn_decoder1, iterations, print_every=500, learning_rate=0.000001, batch_size=batch_size,
+                            max_tokens=max_tokens, num_workers=num_workers, resume=resume) #5000
     evaluateRandomly(encoder1, attn_decoder1)
     return perplexity, encoder1, attn_decoder1
 
@@ -680,6 +939,38 @@ def run_train(iterations):
     return encoder1, attn_decoder1
 
 
+######################################################################
+# Data-parallel training
+# ----------------------
+#
+# ``run_train_distributed`` trains the same models in ``world_size`` CPU
+# processes over gloo (see ``distributed.py``), then reloads the weights
+# rank 0 saved.
+#
+
+def run_train_distributed(iterations, world_size, batch_size=32, resume=False):
+    hidden_size = 512
+    try:
+        encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+        attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    except:
+        encoder1 = EncoderRNN(chat_data.input_lang.n_words, hidden_size).to(device)
+        attn_decoder1 = AttnDecoderRNN(hidden_size, chat_data.output_lang.n_words, dropout_p=0.1).to(device)
+    else:
+        # continuing from saved weights: they must have been trained on this corpus
+        if has_vocab(MODEL_DIR):
+            load_vocab(MODEL_DIR, Lang, chat_data.pairs, encoder1, attn_decoder1, corpus=corpusSettings())
+
+    save_vocab(MODEL_DIR, chat_data.input_lang, chat_data.output_lang, chat_data.pairs, corpus=corpusSettings())
+    stats = train_distributed(encoder1, attn_decoder1, loadCorpus(), iterations, world_size, MODEL_DIR,
+                              batch_size=batch_size, learning_rate=0.000001, print_every=500,
+                              resume=resume)
+    encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+    attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    evaluateRandomly(encoder1, attn_decoder1)
+    return stats, encoder1, attn_decoder1
+
+
 ######################################################################
 # For a better viewing experience we will do the extra work of adding axes
 # and labels:
@@ -711,27 +1002,169 @@ def evaluateAndShowAttention(input_sentence, encoder1, attn_decoder1):
     print('output =', ' '.join(output_words))
     showAttention(input_sentence, output_words, attentions)
 
+######################################################################
+# Chat requests repeat themselves a lot, so responses are kept in an LRU
+# cache keyed by the normalized sentence and the model version (see
+# ``response_cache.py``); every checkpoint loaded keeps entries of its own,
+# and ``run_server`` looks requests up before batching them. Modules in
+# training mode decode with dropout, so they bypass the cache.
+#
+
+response_cache = ResponseCache(maxsize=4096)
+
+
 def evaluateAndReturnResponse(input_sentence, encoder1, attn_decoder1):
-    output_words, attentions = evaluate(
-        encoder1, attn_decoder1, input_sentence)
+    cacheable = not (encoder1.training or attn_decoder1.training)
+    if cacheable:
+        version = response_cache.model_version(encoder1, attn_decoder1)
+        output = response_cache.get(input_sentence, version)
+        if output is not None:
+            return output
+    output_words, _ = evaluate_lean(encoder1, attn_decoder1, input_sentence)
     output = ' '.join(output_words)
+    if cacheable:
+        response_cache.put(input_sentence, version, output)
     return output
 
 
-def calculate_BLEU(encoder1, attn_decoder1, n_examples):
+def calculate_BLEU(encoder1, attn_decoder1, n_examples, batch_size=64, beam_width=1, evaluate_pairs=None,
+                   eos_check_every=None):
     total_score = 0
-    evaluate_pairs = [random.choice(pairs) for i in range(n_examples)]
-    for pair in evaluate_pairs:
-        input_sentence = pair[0]
-        target_words = [pair[1]]
-        output_words, _ = evaluate(encoder1, attn_decoder1, input_sentence)
-        output_words = output_words
-        score = sentence_bleu(target_words, output_words)
-        total_score += score
-    average_BLEU = total_score/len(pairs)
+    if evaluate_pairs is None:
+        evaluate_pairs = [random.choice(chat_data.pairs) for i in range(n_examples)]
+    for start in range(0, len(evaluate_pairs), batch_size):
+        batch_pairs = evaluate_pairs[start:start + batch_size]
+        outputs = evaluate_batch(encoder1, attn_decoder1, [pair[0] for pair in batch_pairs],
+                                 beam_width=beam_width, eos_check_every=eos_check_every)
+        for pair, (output_words, _) in zip(batch_pairs, outputs):
+            target_words = [pair[1]]
+            score = bleu_score.sentence_bleu(target_words, output_words)
+            total_score += score
+    average_BLEU = total_score/len(evaluate_pairs)
     return average_BLEU
 
 
+######################################################################
+# The vocabularies are saved next to the weights (see ``vocab.py``).
+# ``useSavedVocab`` switches to them, so the models are served with the
+# word indexes they were trained with even if the corpus changed since.
+#
+
+def useSavedVocab(encoder1, attn_decoder1, directory=MODEL_DIR):
+    if has_vocab(directory):
+        chat_data.use_vocab(*load_vocab(directory, Lang, encoder=encoder1, decoder=attn_decoder1))
+
+
+######################################################################
+# Serving
+# -------
+#
+# ``run_server`` answers chat requests over HTTP. Concurrent requests are
+# grouped into micro-batches and decoded together with ``evaluate_batch``
+# (see ``chat_server.py``), and ``POST /chat/stream`` sends a reply word by
+# word through ``evaluate_stream``. ``GET /stats`` reports p50/p99 latency
+# and the batch size histogram for tuning ``max_wait_ms`` against
+# ``max_batch_size``. ``quantize`` serves dynamic int8 copies of the models.
+#
+
+def run_server(host='127.0.0.1', port=8000, max_batch_size=32, max_wait_ms=5, quantize=False):
+    encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+    attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    useSavedVocab(encoder1, attn_decoder1)
+    encoder1.eval()
+    attn_decoder1.eval()
+    if quantize:
+        encoder1, attn_decoder1 = quantize_models(encoder1, attn_decoder1)
+
+    def respond(sentences):
+        return [' '.join(output_words) for output_words, _ in evaluate_batch(encoder1, attn_decoder1, sentences)]
+
+    def stream(sentence):
+        return evaluate_stream(encoder1, attn_decoder1, sentence)
+
+    # the version is fixed here, once the weights to serve are loaded
+    version = response_cache.register(encoder1, attn_decoder1)
+    serve(respond, normalizeString, host, port, max_batch_size, max_wait_ms, stream,
+          cache=response_cache, version=version)
+
+
+######################################################################
+# ``run_export`` writes TorchScript versions of the saved models and the
+# vocabularies to ``model/RU-model/scripted``. ``export.ScriptedChatbot`` serves
+# them without importing this script (see ``export.py``).
+#
+
+def run_export(directory=MODEL_DIR + '/scripted'):
+    encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+    attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    useSavedVocab(encoder1, attn_decoder1)
+    export_models(encoder1, attn_decoder1, chat_data.input_lang, chat_data.output_lang, directory, MAX_LENGTH)
+    print('Exported TorchScript models to %s' % directory)
+
+
+######################################################################
+# ``run_quantize`` makes dynamic int8 copies of the saved models (see
+# ``quantization.py``), saves them as ``encoder-int8.pkl`` and
+# ``decoder-int8.pkl``, and compares per-reply latency, model size and
+# BLEU against the fp32 models on the same sample of held-out pairs.
+#
+
+def run_quantize(n_examples=500):
+    encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+    attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    useSavedVocab(encoder1, attn_decoder1)
+    encoder1.eval()
+    attn_decoder1.eval()
+    q_encoder, q_decoder = quantize_models(encoder1, attn_decoder1)
+    torch.save(q_encoder, MODEL_DIR + '/encoder-int8.pkl')
+    torch.save(q_decoder, MODEL_DIR + '/decoder-int8.pkl')
+
+    held_out = heldOutPairs()
+    if not held_out:
+        raise ValueError('no held-out pairs to score; raise HELD_OUT_FRACTION')
+    evaluate_pairs = random.sample(held_out, min(n_examples, len(held_out)))
+
+    def bleu(encoder, decoder):
+        return calculate_BLEU(encoder, decoder, n_examples, evaluate_pairs=evaluate_pairs)
+
+    return compare_models(evaluate, bleu, (encoder1, attn_decoder1), (q_encoder, q_decoder),
+                          [pair[0] for pair in evaluate_pairs])
+
+
+######################################################################
+# ``run_shortlist`` times replies decoded over a vocabulary shortlist
+# against the full projection, and reports how often the unrestricted
+# argmax fell outside the shortlist (see ``shortlist.py``).
+#
+
+def run_shortlist(n_examples=500, top_n=2000, per_word=50):
+    encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+    attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    useSavedVocab(encoder1, attn_decoder1)
+    encoder1.eval()
+    attn_decoder1.eval()
+    shortlist = Shortlist.build(loadCorpus(), chat_data.output_lang, top_n, per_word)
+    sentences = [random.choice(chat_data.pairs)[0] for i in range(n_examples)]
+
+    start = time.time()
+    for sentence in sentences:
+        evaluate(encoder1, attn_decoder1, sentence)
+    full_time = time.time() - start
+    start = time.time()
+    for sentence in sentences:
+        evaluate_shortlist(encoder1, attn_decoder1, sentence, shortlist)
+    shortlist_time = time.time() - start
+    for sentence in sentences:
+        evaluate_shortlist(encoder1, attn_decoder1, sentence, shortlist, check=True)
+
+    print('Shortlist of %.0f words on average (vocabulary %d)' % (shortlist.mean_size(), chat_data.output_lang.n_words))
+    print('%.2f ms per reply against %.2f ms with the full projection' % (
+        shortlist_time / n_examples * 1000, full_time / n_examples * 1000))
+    print('Full-vocabulary argmax outside the shortlist: %.2f%% of %d steps' % (
+        shortlist.miss_rate() * 100, shortlist.steps))
+    return shortlist
+
+
 #evaluateAndShowAttention("elle a cinq ans de moins que moi .")
 if __name__ == '__main__':
 
@@ -746,8 +1179,32 @@ if __name__ == '__main__':
     #     if opt == "--iters":
     #         iters = arg
     # to train a chatbot
-
-    perplexity, _, _ = run_train(iterations=150000) #75000
+    # --resume picks up from the latest checkpoint instead of starting over
+    # --serve [--port=N] [--quantize] starts the HTTP chat server instead,
+    # --export writes TorchScript models, --quantize alone compares int8 against fp32,
+    # --shortlist reports the speed and miss rate of a vocabulary shortlist,
+    # --distributed [--world-size=N] trains in N CPU processes (default 2)
+    opts, args = getopt.getopt(sys.argv[1:], "", ["resume", "serve", "port=", "export", "quantize", "shortlist",
+                                                   "distributed", "world-size="])
+    opts = dict(opts)
+    if "--serve" in opts:
+        run_server(port=int(opts.get("--port", 8000)), quantize="--quantize" in opts)
+        sys.exit()
+    if "--export" in opts:
+        run_export()
+        sys.exit()
+    if "--quantize" in opts:
+        run_quantize()
+        sys.exit()
+    if "--shortlist" in opts:
+        run_shortlist()
+        sys.exit()
+    resume = "--resume" in opts
+    if "--distributed" in opts:
+        run_train_distributed(iterations=150000, world_size=int(opts.get("--world-size", 2)), resume=resume)
+        sys.exit()
+
+    perplexity, _, _ = run_train(iterations=150000, resume=resume) #75000
     print('Perplexity: ', perplexity)
 
     
@@ -756,8 +1213,11 @@ if __name__ == '__main__':
     #     # to test a chatbot
     print("---------------test bot---------------")
     
-    encoder1 = torch.load('model/Ru-model/encoder.pkl')
-    attn_decoder1 = torch.load('model/Ru-model/decoder.pkl')
+    encoder1 = torch.load(MODEL_DIR + '/encoder.pkl')
+    attn_decoder1 = torch.load(MODEL_DIR + '/decoder.pkl')
+    useSavedVocab(encoder1, attn_decoder1)
+    encoder1.eval()
+    attn_decoder1.eval()
     input_sentences = ["привет","как дела", "кто ты?", "что ты делаешь?", "Зачем"]
     for sen in input_sentences:
         sen = normalizeString(sen)
@@ -0,0 +1,86 @@
+import random
+
+######################################################################
+# Length-bucketed batch sampling
+# ==============================
+#
+# ``random.choice(pairs)`` samples with replacement, so an epoch never sees
+# the corpus exactly once, and random batches of very different lengths
+# spend most of their compute on padding. ``BucketBatchSampler`` instead
+# walks the whole corpus once per epoch: pairs are grouped into buckets of
+# similar length, cut into batches under a token budget, and the batch order
+# is shuffled with an RNG seeded from ``seed + epoch`` so runs are
+# reproducible.
+#
+
+
+class BucketBatchSampler:
+    def __init__(self, lengths, batch_size=32, max_tokens=None, bucket_width=4, seed=0, shuffle=True):
+        # ``lengths`` holds one (input_len, target_len) tuple per pair, in tokens
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        self.start = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def set_epoch(self, epoch, start=0):
+        # ``start`` skips the batches of this epoch that were already trained
+        # on, so a resumed run continues mid-epoch
+        self.epoch = epoch
+        self.start = start
+
+    def _batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            # shuffle first so pairs of equal length land in different batches each epoch
+            rng.shuffle(indices)
+
+        buckets = {}
+        for i in indices:
+            buckets.setdefault(max(self.lengths[i]) // self.bucket_width, []).append(i)
+
+        batches = []
+        for key in sorted(buckets):
+            bucket = sorted(buckets[key], key=lambda i: self.lengths[i])
+            batch = []
+            max_in = max_out = 0
+            for i in bucket:
+                in_len, out_len = self.lengths[i]
+                new_in, new_out = max(max_in, in_len), max(max_out, out_len)
+                cost = (len(batch) + 1) * (new_in + new_out)
+                if batch and (len(batch) >= self.batch_size or
+                              (self.max_tokens is not None and cost > self.max_tokens)):
+                    batches.append(batch)
+                    batch = []
+                    new_in, new_out = in_len, out_len
+                batch.append(i)
+                max_in, max_out = new_in, new_out
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        for batch in self._batches()[self.start:]:
+            in_lens = [self.lengths[i][0] for i in batch]
+            out_lens = [self.lengths[i][1] for i in batch]
+            self.real_tokens += sum(in_lens) + sum(out_lens)
+            self.padded_tokens += len(batch) * (max(in_lens) + max(out_lens))
+            yield batch
+
+    def __len__(self):
+        return len(self._batches())
+
+    def padding_efficiency(self):
+        # Fraction of the padded (T, B) positions that hold real tokens
+        if self.padded_tokens == 0:
+            return 1.0
+        return self.real_tokens / self.padded_tokens
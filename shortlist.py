@@ -0,0 +1,72 @@
+from collections import Counter, defaultdict
+import torch
+
+from batching import SOS_token, EOS_token
+
+######################################################################
+# Output vocabulary shortlist
+# ===========================
+#
+# Every decoder step projects onto the whole output vocabulary, which for
+# the OpenSubtitles and Twitter data is the largest matmul in the model.
+# A ``Shortlist`` picks, per input sentence, the words worth scoring:
+#
+# -  the ``top_n`` most frequent output words (``Lang.word2count``), and
+# -  for every input word, the ``per_word`` output words it most often
+#    appears with in the training pairs, beyond the frequent ones.
+#
+# ``inference.shortlist_decode`` then projects onto those rows of ``out``
+# only. When asked to check, it also runs the full projection and counts
+# the steps whose unrestricted argmax was not on the shortlist; those are
+# the only steps where the restricted decode can pick a different word.
+#
+
+
+class Shortlist:
+    def __init__(self, frequent, cooccurring):
+        self.frequent = frequent  # set of output indexes
+        self.cooccurring = cooccurring  # input index -> list of output indexes
+        self.sentences = 0
+        self.candidates_total = 0
+        self.steps = 0
+        self.misses = 0
+
+    @classmethod
+    def build(cls, corpus, output_lang, top_n=2000, per_word=50):
+        # ``corpus`` is the TensorCorpus of the training pairs (see corpus_cache.py)
+        frequent = {SOS_token, EOS_token}
+        frequent.update(output_lang.word2index[word] for word, _ in
+                        Counter(output_lang.word2count).most_common(top_n))
+
+        counts = defaultdict(Counter)
+        for i in range(len(corpus)):
+            src, tgt = corpus.indexes(i)
+            targets = set(tgt.tolist())
+            for index in set(src.tolist()):
+                counts[index].update(targets)
+
+        cooccurring = {}
+        for index, counter in counts.items():
+            words = [word for word, _ in counter.most_common() if word not in frequent]
+            cooccurring[index] = words[:per_word]
+        return cls(frequent, cooccurring)
+
+    def candidates(self, input_indexes, device=None):
+        # sorted LongTensor of the output indexes to score for this input
+        words = set(self.frequent)
+        for index in input_indexes:
+            words.update(self.cooccurring.get(index, ()))
+        self.sentences += 1
+        self.candidates_total += len(words)
+        return torch.tensor(sorted(words), dtype=torch.long, device=device)
+
+    def record(self, steps, misses):
+        self.steps += steps
+        self.misses += misses
+
+    def miss_rate(self):
+        # fraction of checked steps whose full-vocabulary argmax fell outside the shortlist
+        return self.misses / self.steps if self.steps else 0.0
+
+    def mean_size(self):
+        return self.candidates_total / self.sentences if self.sentences else 0.0
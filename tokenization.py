@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
+######################################################################
+# Cached word segmentation
+# ========================
+#
+# Vietnamese words span several syllables, so vi_bot.py segments every
+# sentence with ``pyvi.ViTokenizer`` ("đại học" -> "đại_học") before
+# counting or indexing words. Segmentation is slow, and the same sentence
+# used to go through it in ``filterPair``, again in ``Lang.addSentence``
+# and again in ``indexesFromSentence``.
+#
+# ``CachedTokenizer`` segments each distinct sentence once. ``tokenize_batch``
+# (which ``prepareData`` calls on the whole corpus) spreads the sentences it
+# has not seen yet over a process pool, and appends the results to a file
+# under ``data/cache``, one ``hash\tsegmented sentence`` line each, so later
+# runs load them instead of segmenting again. ``tokenize`` reads the same
+# cache, so filtering, vocabulary building and training split a sentence
+# the same way; a sentence outside it (a user's message, at inference) is
+# kept in a small in-memory LRU only, so serving never writes to the file
+# and its memory stays bounded.
+#
+
+CACHE_DIR = 'data/cache'
+
+
+def sentence_key(sentence):
+    return hashlib.sha1(sentence.encode('utf-8')).hexdigest()[:16]
+
+
+class CachedTokenizer:
+    def __init__(self, segment, path, workers=None, min_parallel=1000, max_recent=10000):
+        # ``segment(sentence)`` returns the sentence with its words separated by spaces
+        self.segment = segment
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel = min_parallel  # fewer new sentences than this are segmented in-process
+        self._segmented = None  # key -> segmented sentence, read from ``path`` on first use
+        self.max_recent = max_recent
+        self._recent = OrderedDict()  # key -> segmented sentence ``tokenize`` found outside the file, LRU first
+        self._lock = threading.Lock()
+
+    def _load(self):
+        segmented = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8', newline='\n') as f:
+                for line in f:
+                    # a last line without its newline was cut short by an interrupted run
+                    key, sep, value = line[:-1].partition('\t')
+                    if sep and line.endswith('\n'):
+                        segmented[key] = value
+        return segmented
+
+    def _cache(self):
+        if self._segmented is None:
+            with self._lock:
+                if self._segmented is None:
+                    self._segmented = self._load()
+        return self._segmented
+
+    def _store(self, items):
+        # a segmented sentence with a newline in it stays in memory only
+        lines = ['%s\t%s\n' % (key, value) for key, value in items if '\n' not in value]
+        if not lines:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock, open(self.path, 'a', encoding='utf-8', newline='\n') as f:
+            f.write(''.join(lines))
+
+    def tokenize(self, sentence):
+        # list of words, as ``segment(sentence).split(' ')``
+        cache = self._cache()
+        key = sentence_key(sentence)
+        value = cache.get(key)
+        if value is None:
+            with self._lock:
+                value = self._recent.pop(key, None)
+            if value is None:
+                value = self.segment(sentence)
+            with self._lock:
+                self._recent[key] = value
+                if len(self._recent) > self.max_recent:
+                    self._recent.popitem(last=False)
+        return value.split(' ')
+
+    def tokenize_batch(self, sentences):
+        cache = self._cache()
+        missing = {}
+        for sentence in sentences:
+            key = sentence_key(sentence)
+            if key not in cache:
+                missing[key] = sentence
+        if missing:
+            # sentences ``tokenize`` already segmented move from the LRU to the file
+            with self._lock:
+                found = {key: self._recent.pop(key) for key in missing if key in self._recent}
+            todo = [key for key in missing if key not in found]
+            if self.workers > 1 and len(todo) >= self.min_parallel:
+                with Pool(self.workers) as pool:
+                    values = pool.map(self.segment, [missing[key] for key in todo],
+                                      chunksize=max(1, len(todo) // (4 * self.workers)))
+            else:
+                values = [self.segment(missing[key]) for key in todo]
+            found.update(zip(todo, values))
+            cache.update(found)
+            self._store(found.items())
+        return [cache[sentence_key(sentence)].split(' ') for sentence in sentences]
+
+    def __len__(self):
+        return len(self._cache())
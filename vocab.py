@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+
+######################################################################
+# Saved vocabularies
+# ==================
+#
+# A ``Lang`` gives every word the next free index the first time
+# ``addWord`` sees it, so the indexes depend on the exact corpus and its
+# order. They used to be rebuilt on every start and never saved, and a
+# model trained on one version of the corpus could be served with the
+# indexes of another without any error.
+#
+# ``save_vocab`` writes both vocabularies to ``vocab.json`` next to
+# ``encoder.pkl``/``decoder.pkl``: the words in index order with their
+# counts, the special entries, a hash of the training pairs they were
+# counted from, the settings those pairs were prepared with
+# (deduplication, see ``dedup.py``), and a hash of the file's own
+# contents. ``load_vocab`` rebuilds the ``Lang`` objects from that file,
+# without the corpus. It raises ``ValueError`` when the file is damaged,
+# when it was built from other pairs than the ones given, or when its
+# sizes do not match the models' embedding and output layers.
+#
+# ``corpus_settings`` reads the recorded settings back, so a script can
+# prepare its pairs the way an existing model's vocabulary expects. Files
+# written before the settings were recorded were counted from pairs that
+# were not deduplicated.
+#
+
+VOCAB_FILE = 'vocab.json'
+LEGACY_CORPUS_SETTINGS = dict(dedup=False)
+
+
+def corpus_hash(pairs):
+    h = hashlib.sha1()
+    for pair in pairs:
+        h.update(('%s\t%s\n' % (pair[0], pair[1])).encode('utf-8'))
+    return h.hexdigest()
+
+
+def lang_state(lang):
+    words = sorted(lang.word2index, key=lang.word2index.get)
+    first = lang.word2index[words[0]] if words else lang.n_words
+    if [lang.word2index[word] for word in words] != list(range(first, first + len(words))):
+        raise ValueError('%s indexes are not contiguous' % lang.name)
+    return dict(name=lang.name, first=first, words=words,
+                counts=[lang.word2count[word] for word in words],
+                specials={str(i): word for i, word in lang.index2word.items() if not first <= i < lang.n_words})
+
+
+def restore_lang(lang_cls, state):
+    lang = lang_cls(state['name'])
+    first = state['first']
+    lang.word2index = {word: first + i for i, word in enumerate(state['words'])}
+    lang.word2count = dict(zip(state['words'], state['counts']))
+    lang.index2word = {int(i): word for i, word in state['specials'].items()}
+    lang.index2word.update((index, word) for word, index in lang.word2index.items())
+    lang.n_words = first + len(state['words'])
+    return lang
+
+
+def _content_hash(langs):
+    return hashlib.sha1(json.dumps(langs, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def save_vocab(directory, input_lang, output_lang, pairs, corpus=None):
+    # ``corpus``: the settings ``pairs`` were prepared with
+    langs = [lang_state(input_lang), lang_state(output_lang)]
+    data = dict(version=1, corpus_hash=corpus_hash(pairs), corpus=corpus or {}, hash=_content_hash(langs),
+                langs=langs)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, VOCAB_FILE)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def has_vocab(directory):
+    return os.path.exists(os.path.join(directory, VOCAB_FILE))
+
+
+def corpus_settings(directory):
+    # settings recorded in ``directory``'s vocabulary, {} if it has none
+    path = os.path.join(directory, VOCAB_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('corpus', LEGACY_CORPUS_SETTINGS)
+
+
+def _format_settings(settings):
+    return ', '.join('%s=%r' % item for item in sorted(settings.items()))
+
+
+def load_vocab(directory, lang_cls, pairs=None, encoder=None, decoder=None, corpus=None):
+    # (input_lang, output_lang) saved in ``directory``; ``corpus``: the settings ``pairs`` were prepared with
+    path = os.path.join(directory, VOCAB_FILE)
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if _content_hash(data['langs']) != data['hash']:
+        raise ValueError('%s is damaged: its contents do not match its hash' % path)
+    if pairs is not None and corpus_hash(pairs) != data['corpus_hash']:
+        saved = data.get('corpus', LEGACY_CORPUS_SETTINGS)
+        if corpus is not None and any(corpus.get(key) != value for key, value in saved.items()):
+            raise ValueError('%s was built from pairs prepared with %s, but these were prepared with %s; '
+                             'retrain, or prepare the pairs with the recorded settings' % (
+                                 path, _format_settings(saved), _format_settings(corpus)))
+        raise ValueError('%s was built from a different corpus; its word indexes would not match' % path)
+    input_lang, output_lang = (restore_lang(lang_cls, state) for state in data['langs'])
+    if encoder is not None and encoder.embedding.num_embeddings != input_lang.n_words:
+        raise ValueError('%s has %d input words, the encoder %d' % (
+            path, input_lang.n_words, encoder.embedding.num_embeddings))
+    if decoder is not None and decoder.output_size != output_lang.n_words:
+        raise ValueError('%s has %d output words, the decoder %d' % (
+            path, output_lang.n_words, decoder.output_size))
+    return input_lang, output_lang